@@ -1,6 +1,7 @@
+import collections
+import concurrent.futures
 import time
 import numpy
-import threading
 from ophyd import select_version, Component, Device, EpicsSignalRO, \
     EpicsSignal, ADBase, ADComponent, EpicsSignalWithRBV, \
     DetectorBase, CamBase, HDF5Plugin, ADTriggerStatus
@@ -10,18 +11,44 @@ from ophyd.areadetector.plugins import PluginBase
 from ophyd.areadetector.filestore_mixins import \
     FileStoreHDF5, FileStoreIterativeWrite
 from ophyd.utils.errors import UnprimedPlugin
-from .ophyd import ThrottleMonitor
+from .ophyd import ImageMonitor, pulse_wait
 
 MyHDF5Plugin = select_version(HDF5Plugin, (3, 15))
 
+# Triggers are completed by monitor callbacks, and fail after
+# `trigger_timeout' seconds (None for no timeout); the latencies of the
+# latest successful triggers are kept in `trigger_latencies'.
 class MyTriggerBase(BlueskyInterface):
     _status_type = ADTriggerStatus
+    _status, trigger_timeout = None, None
 
     def __init__(self, *args, image_name = None, **kwargs):
         super().__init__(*args, **kwargs)
         if image_name is None:
             image_name = "_".join([self.name, "image"])
         self._image_name, self._datum_keys = image_name, [image_name]
+        self.trigger_latencies = collections.deque(maxlen = 1000)
+
+    def _new_status(self, timeout = None):
+        t = time.time()
+        status = self._status_type(self, timeout = timeout)
+        def cb(status):
+            if status.success:
+                self.trigger_latencies.append(time.time() - t)
+            else:
+                if self._status is status:
+                    self._status = None
+                self._trigger_failed()
+        status.add_callback(cb)
+        return status
+
+    def _trigger_failed(self):
+        pass
+
+    def _finish_status(self):
+        status, self._status = self._status, None
+        if status is not None and not status.done:
+            status.set_finished()
 
 class SoftTrigger(MyTriggerBase):
     _acquisition_signal = "cam.acquire"
@@ -53,7 +80,7 @@ class SoftTrigger(MyTriggerBase):
 
     def trigger(self):
         assert self._staged == Staged.yes
-        self._status = self._status_type(self)
+        self._status = self._new_status(self.trigger_timeout)
         self._acquisition_signal.put(1)
         self.dispatch(self._image_name, time.time())
         return self._status
@@ -62,8 +89,7 @@ class SoftTrigger(MyTriggerBase):
         if self._status is None:
             return
         if (self._counter_signal and value) or (old_value == 1 and value == 0):
-            status, self._status = self._status, None
-            status.set_finished()
+            self._finish_status()
 
 class Xsp3Trigger(SoftTrigger):
     def _maybe_erase(self):
@@ -95,37 +121,36 @@ class Xsp3Trigger(SoftTrigger):
         if self._status is None:
             return
         if (self._counter_signal and value) or (old_value == 1 and value == 0):
-            status, self._status = self._status, None
             if self.stage_sigs["cam.acquire"]:
                 self._acquisition_signal.put(0)
-            status.set_finished()
+            self._finish_status()
 
+# `trigger_timeout' is in addition to the preset real time.
 class DxpTrigger(MyTriggerBase):
-    def wait_finish(self):
-        self.cam.erase_start.put(1)
-        time.sleep(self.cam.preset_real.get())
-        for i in range(100):
-            if not self.cam.acquiring.get():
-                break
-            time.sleep(0.02)
-        else:
-            self.cam.stop_all.put(1)
-            raise TimeoutError\
-                ("Timeout waiting for %r to be low" % self.cam.acquiring)
+    trigger_timeout = 2.0
+
+    def stage(self):
+        self.cam.acquiring.subscribe(self._acquiring_changed, run = False)
+        super().stage()
+
+    def unstage(self):
+        super().unstage()
+        self.cam.acquiring.clear_sub(self._acquiring_changed)
 
     def trigger(self):
         assert self._staged == Staged.yes
-        status = self._status_type(self)
+        self._status = self._new_status\
+            (self.cam.preset_real.get() + self.trigger_timeout)
         self.dispatch(self._image_name, time.time())
-        def wait():
-            try:
-                self.wait_finish()
-            except Exception as exc:
-                status.set_exception(exc)
-                raise
-            status.set_finished()
-        threading.Thread(target = wait, daemon = True).start()
-        return status
+        self.cam.erase_start.put(1)
+        return self._status
+
+    def _trigger_failed(self):
+        self.cam.stop_all.put(1)
+
+    def _acquiring_changed(self, *, value, old_value, **kwargs):
+        if self._status is not None and old_value and not value:
+            self._finish_status()
 
 class DxpDetectorBase(DetectorBase):
     make_data_key = lambda self: dict(
@@ -146,7 +171,7 @@ class CptHDF5(MyHDF5Plugin, FileStoreHDF5, FileStoreIterativeWrite):
 class CptHDF5Dxp(CptHDF5):
     get_frames_per_point = lambda self: 1
 
-class MyImagePlugin(ThrottleMonitor, PluginBase):
+class MyImagePlugin(ImageMonitor, PluginBase):
     _plugin_type = "NDPluginStdArrays"
     array_size, array_data = DDC_EpicsSignalRO(
         ("depth", "ArraySize2_RBV"), ("height", "ArraySize1_RBV"),
@@ -170,10 +195,10 @@ class MyImagePlugin(ThrottleMonitor, PluginBase):
                 if all(shape):
                     break
                 shape.pop(0)
-            dnotify("monitor/image", {
-                "data": {image_name: value[:numpy.prod(shape)].reshape(shape)},
-                "timestamps": {image_name: timestamp}
-            })
+            data = self.reduce_image\
+                (image_name, value[:numpy.prod(shape)].reshape(shape))
+            dnotify("monitor/image", {"data": data,
+                "timestamps": dict((k, timestamp) for k in data)})
         return self.array_data.subscribe(cb, run = False)
 
 class MyCam(CamBase):
@@ -182,20 +207,10 @@ class MyCam(CamBase):
     def warmup(self, sleep = None):
         if sleep is None:
             sleep = self.warmup_sleep
-        sigs = [(self.array_callbacks, 1), (self.acquire, 1)]
-        orig_vals = [(sig, sig.get()) for sig, val in sigs]
-
-        for sig, val in sigs:
-            sig.put(val)
-            time.sleep(0.1)
-        for i in range(int(sleep[0] / 0.1)):
-            if self.acquire.get():
-                break
-            time.sleep(0.1)
-        for i in range(int(sleep[1] / 0.1)):
-            if not self.acquire.get():
-                break
-            time.sleep(0.1)
+        orig_vals = [(sig, sig.get())
+            for sig in [self.array_callbacks, self.acquire]]
+        self.array_callbacks.set(1).wait()
+        pulse_wait(self.acquire, lambda: self.acquire.put(1), sleep)
         for sig, val in reversed(orig_vals):
             sig.set(val).wait()
 
@@ -234,8 +249,8 @@ class DxpCam(ADBase):
     acquiring = ADComponent(EpicsSignal, "Acquiring")
 
     def warmup(self):
-        self.erase_start.put(1)
-        time.sleep(min(2.0, self.preset_real.get()))
+        pulse_wait(self.acquiring, lambda: self.erase_start.put(1),
+            (1.0, min(2.0, self.preset_real.get())))
         self.stop_all.put(1)
 
 class SitoroCam(DxpCam):
@@ -246,7 +261,11 @@ class SitoroCam(DxpCam):
 def make_detector(name, inherit = None, **kwargs):
     if not inherit:
         inherit = (SoftTrigger, DetectorBase)
+    # Returns False if skipped, as the plugin was already primed.
     def warmup(obj):
+        if sum(obj.hdf1.array_size.get()):
+            obj.hdf1.warmup()
+            return False
         obj.hdf1.enable.set(1).wait()
         obj.hdf1.warmup()
         obj.cam.warmup()
@@ -269,6 +288,27 @@ def make_detector(name, inherit = None, **kwargs):
             attrs[k] = v
     return type(name, inherit, attrs)
 
+# Warms up `dets' concurrently, reporting the time taken by each; the first
+# exception, if any, is raised after all of them are done.
+def warmup_all(dets):
+    def warmup(det):
+        t = time.time()
+        return det.warmup(), time.time() - t
+    with concurrent.futures.ThreadPoolExecutor(max(1, len(dets))) as pool:
+        futures = [pool.submit(warmup, det) for det in dets]
+    ret, exc = {}, None
+    for det, f in zip(dets, futures):
+        if f.exception():
+            exc = exc or f.exception()
+            print("%s: warm-up failed: %r" % (det.name, f.exception()))
+            continue
+        skipped, ret[det] = f.result()
+        print("%s: already primed" % det.name if skipped is False
+            else "%s: warmed up in %.2f s" % (det.name, ret[det]))
+    if exc:
+        raise exc
+    return ret
+
 def make_xsp3(name, nchan = 0, soft_trigger = True):
     ids = [i + 1 for i in range(nchan)]
     attrs = {"_default_read_attrs": ["ch%d_dtperc" % i for i in ids] + ["hdf1"]}
@@ -1,3 +1,6 @@
+import concurrent.futures
+import h5py
+import numpy
 import queue
 import re
 import threading
@@ -8,46 +11,168 @@ from ophyd.areadetector.filestore_mixins import new_short_uid
 
 sseq_disable = lambda bubo: time.sleep(0.1)
 
+# Numeric columns are kept as float64 (complex128 if complex), as the first
+# reading may well be an integer where later ones are not.
+def rec_dtype(val):
+    dtype = numpy.asarray(val).dtype
+    return object if dtype.kind in "OSU" else \
+        numpy.dtype("complex128" if dtype.kind == "c" else "float64")
+
+def rec_put(buf, i, val):
+    dtype = numpy.asarray(val).dtype
+    if (buf.dtype == object) != (dtype.kind in "OSU") or (buf.dtype != object
+        and not numpy.can_cast(dtype, buf.dtype)):
+        raise TypeError("cannot record %r (%s) into a column of %s" %
+            (val, dtype, buf.dtype))
+    buf[i] = val
+
+# Readings are appended to preallocated column buffers, which are handed in
+# chunks of `chunk' rows to a writer thread, so that the sequence thread never
+# blocks on formatting or I/O; write() is to be overridden.
+class BuboRecorder(object):
+    def __init__(self, path, chunk = 1024):
+        self.path, self.chunk, self.fields = path, chunk, None
+        self.bufs, self.n, self.exc, self.q = None, 0, None, queue.Queue()
+        self.thread = threading.Thread(target = self.writer, daemon = True)
+        self.thread.start()
+
+    def append(self, t, data):
+        if self.fields is None:
+            self.fields = ["time"] + list(data.keys())
+            self.bufs = [numpy.empty((self.chunk,) + numpy.shape(v),
+                dtype = rec_dtype(v)) for v in [t] +
+                [data[f]["value"] for f in self.fields[1:]]]
+        self.bufs[0][self.n] = t
+        for buf, f in zip(self.bufs[1:], self.fields[1:]):
+            rec_put(buf, self.n, data[f]["value"])
+        self.n += 1
+        if self.n == self.chunk:
+            self.flush()
+
+    def flush(self):
+        if self.n:
+            self.q.put([buf[:self.n] for buf in self.bufs])
+            self.bufs = [numpy.empty_like(buf) for buf in self.bufs]
+            self.n = 0
+
+    def writer(self):
+        while True:
+            cols = self.q.get()
+            try:
+                if cols is None:
+                    return self.finish()
+                if not self.exc:
+                    self.write(cols)
+            except Exception as e:
+                self.exc = self.exc or e
+
+    def close(self):
+        self.flush()
+        self.q.put(None)
+        self.thread.join()
+        if self.exc:
+            raise self.exc
+
+    def write(self, cols):
+        pass
+
+    def finish(self):
+        pass
+
+class BuboHDF5(BuboRecorder):
+    file = None
+
+    def write(self, cols):
+        if self.file is None:
+            self.file = h5py.File(self.path, "w", libver = "latest")
+            self.dsets = [self.file.create_dataset(f, (0,) + c.shape[1:],
+                dtype = h5py.string_dtype() if c.dtype == object else c.dtype,
+                maxshape = (None,) + c.shape[1:],
+                chunks = (self.chunk,) + c.shape[1:])
+                for f, c in zip(self.fields, cols)]
+            self.file.swmr_mode = True
+        for dset, col in zip(self.dsets, cols):
+            dset.resize(len(dset) + len(col), axis = 0)
+            dset[-len(col):] = col
+            dset.flush()
+
+    def finish(self):
+        if self.file is not None:
+            self.file.close()
+
+class BuboCSV(BuboRecorder):
+    file = None
+
+    def write(self, cols):
+        if self.file is None:
+            self.file = open(self.path, "w")
+            self.file.write("%s\n" % ",".join(self.fields))
+        self.file.write("".join("%s\n" % ",".join(map(str, row))
+            for row in zip(*cols)))
+        self.file.flush()
+
+    def finish(self):
+        if self.file is not None:
+            self.file.close()
+
+buboRecorders = {"h5": BuboHDF5, "csv": BuboCSV}
+
 class BuboBubo(object):
     def __init__(self):
         self.seq = sseq_disable
-        self.fp = self.q = self.fields = None
+        self.rec = self.q = self.pool = None
         self.inputs, self.outputs, self.roots = [], [], []
+        self.aborted = threading.Event()
 
     def put(self, *msg):
         q = self.q
         if q:
             q.put(msg)
 
-    def get(self):
-        return self.q.get()
-
-    def legend(self):
-        self.fp.write("time%s\n" % "".join("," + o.name for o in self.outputs))
-        self.fp.flush()
-
-    def record(self):
-        for r in self.roots:
-            r.trigger().add_callback\
-                ((lambda r: lambda s: self.put("trigger", r, s))(r))
-        roots = set(self.roots)
-        while roots:
-            msg = self.get()
-            if msg[0] == "exit":
-                return False
-            if msg[0] == "trigger":
-                roots.remove(msg[1])
-                msg[2].wait()
+    def get(self, *args, **kwargs):
+        return self.q.get(*args, **kwargs)
+
+    # Triggers the root, and then reads its outputs, on a worker of the pool;
+    # returns None if aborted before the trigger is done.
+    def acquire(self, root):
+        done = threading.Event()
+        status = root.trigger()
+        status.add_callback(lambda s: done.set())
+        while not done.wait(0.1):
+            if self.aborted.is_set():
+                return None
+        status.wait()
+        return dict((i, o.read()) for i, o in enumerate(self.outputs)
+            if o.root is root)
+
+    # Triggers and reads all outputs; returns the time and the readings, or
+    # None if aborted.
+    def acquire_all(self):
+        t = time.time()
+        futures = [self.pool.submit(self.acquire, r) for r in self.roots]
+        reads = {}
+        for f in futures:
+            r = f.result()
+            if r is None:
+                return None
+            reads.update(r)
         # Insertion order preserved by dict() since Python 3.6.
         data = {}
-        for o in self.outputs:
-            data.update(o.read())
-        if self.fields is None:
-            self.fields = list(data.keys())
-            self.fp.write("time%s\n" % "".join("," + f for f in self.fields))
-        self.fp.write("%s%s\n" % (time.time(),
-            "".join(",%s" % data[f]["value"] for f in self.fields)))
-        self.fp.flush()
+        for i in range(len(self.outputs)):
+            data.update(reads[i])
+        data["bubo_latency"] = {"value": time.time() - t}
+        return t, data
+
+    # `extra' are recorded as additional columns, eg. errors of positions.
+    def append(self, t, data, **extra):
+        data.update(("bubo_" + k, {"value": v}) for k, v in extra.items())
+        self.rec.append(t, data)
+
+    def record(self, **extra):
+        ret = self.acquire_all()
+        if ret is None:
+            return False
+        self.append(*ret, **extra)
         return True
 
     def bind(self, seq = None, inputs = None, outputs = None):
@@ -61,29 +186,33 @@ class BuboBubo(object):
             for d in outputs:
                 if d.root not in self.roots:
                     self.roots.append(d.root)
+            if self.pool:
+                self.pool.shutdown(wait = False)
+            self.pool = concurrent.futures.ThreadPoolExecutor\
+                (max(1, len(self.roots)), thread_name_prefix = "bubo")
 
     def capture(self, record):
         assert not self.q
-        if self.fp:
-            self.fp.close()
-            self.fp = None
+        if self.rec:
+            rec, self.rec = self.rec, None
+            rec.close()
         if record:
-            self.fp = open(record, "w")
-            self.fields = None
+            self.rec = buboRecorders[record.rsplit(".", 1)[-1]](record)
 
     def start(self):
-        assert self.fp and not self.q
+        assert self.rec and not self.q
         status, self.q = Status(self), queue.Queue()
+        self.aborted.clear()
         subs = [(i, i.subscribe((lambda i:
             lambda *, value, **kwargs:
-            value is not None and self.put("input", i, value)
+            value is not None and self.put("input", i, value, time.time())
         )(i))) for i in self.inputs]
         def unsubscribe():
             for i, sub in subs:
                 i.unsubscribe(sub)
         def seq():
             exc = None
-            for fn in [(lambda: self.seq(self)), unsubscribe]:
+            for fn in [(lambda: self.seq(self)), unsubscribe, self.rec.flush]:
                 try:
                     fn()
                 except Exception as e:
@@ -99,6 +228,7 @@ class BuboBubo(object):
         return status
 
     def abort(self):
+        self.aborted.set()
         self.put("exit")
 
 class BuboBind(Signal):
@@ -125,7 +255,7 @@ class BuboCapture(Signal):
         super().put(self.get())
 
     def get(self):
-        return int(self.root._bubo.fp is not None)
+        return int(self.root._bubo.rec is not None)
 
     def describe(self, dot = False):
         return {self.vname(dot):
@@ -151,7 +281,8 @@ class BuboDevice(Device):
         for name in ["seq", "inputs", "outputs"]]
     capture = Component(BuboCapture, kind = "omitted")
     enable = Component(BuboEnable, kind = "omitted")
-    write_dir, full_path = "/", ""
+    # Recorder format, as a key of `buboRecorders'.
+    write_dir, full_path, record_format = "/", "", "h5"
 
     def __init__(self, **kwargs):
         self._bubo = BuboBubo()
@@ -159,8 +290,8 @@ class BuboDevice(Device):
 
     def stage(self):
         super().stage()
-        self.full_path = "%s/%s.csv" % \
-            (re.sub("/+$", "", self.write_dir), new_short_uid())
+        self.full_path = "%s/%s.%s" % (re.sub("/+$", "", self.write_dir),
+            new_short_uid(), self.record_format)
         self.capture.set(1, timeout = 1.0).wait()
 
     def unstage(self):
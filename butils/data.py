@@ -1,3 +1,4 @@
+import collections
 import h5py
 import numpy
 import pyqtgraph
@@ -58,12 +59,115 @@ class ProcessorCallback(CallbackBase):
     def stop(self, doc):
         self.postproc(*[self.data[k] for k in self.fields])
 
+# Proxy for frame `idx' (or, with `num', the `num' frames from `idx') of an
+# HDF5 dataset, read (and cached) only when used as an array; indexing
+# before that reads only the selected part.
+class LazyFrame(object):
+    def __init__(self, dataset, idx, num = None):
+        self.dataset, self.idx, self.num, self.value = dataset, idx, num, None
+        self.shape, self.dtype = dataset.shape[1:], dataset.dtype
+        if num is not None:
+            self.shape = (num,) + self.shape
+        self.ndim = len(self.shape)
+
+    def read(self, key = ()):
+        if self.idx + (self.num or 1) > self.dataset.shape[0]:
+            self.dataset.refresh()
+        return self.dataset[((self.idx,) if self.num is None else
+            (slice(self.idx, self.idx + self.num),)) + key]
+
+    def __array__(self, dtype = None, copy = None):
+        if self.value is None:
+            self.value = self.read()
+        return self.value if dtype is None else self.value.astype(dtype)
+
+    def __getitem__(self, key):
+        if self.value is not None:
+            return self.value[key]
+        return self.read(key if isinstance(key, tuple) else (key,))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __reduce__(self):
+        return numpy.asarray, (numpy.asarray(self),)
+
+# Reads the frames of `points' (each of `fpp' frames) from dataset `d' with
+# at most one refresh and one selection, along with up to `ahead' later
+# points if the selection is contiguous; points of `fpp' > 1 are returned as
+# stacks of frames, which are views into the block read.
+def points_read(d, fpp, points, ahead = 0):
+    lo, hi = points[0], points[-1] + 1
+    if hi * fpp > d.shape[0]:
+        d.refresh()
+    if hi - lo <= 2 * len(points):
+        points = range(lo, max(hi, min(hi + ahead, d.shape[0] // fpp)))
+        block = d[lo * fpp : points[-1] * fpp + fpp]
+    else:
+        block = d[[i * fpp + j for i in points for j in range(fpp)]]
+    return dict((i, block[j] if fpp == 1 else
+        block[j * fpp : (j + 1) * fpp]) for j, i in enumerate(points))
+
+# Reads the lazy frames in `frames' that are not yet read, batched per
+# dataset as in ImageFiller.
+def frames_load(frames):
+    groups = collections.OrderedDict()
+    for x in frames:
+        if x.value is None:
+            groups.setdefault((id(x.dataset), x.num), []).append(x)
+    for xs in groups.values():
+        fpp = xs[0].num or 1
+        block = points_read(xs[0].dataset, fpp,
+            sorted(set(x.idx // fpp for x in xs)))
+        for x in xs:
+            x.value = block[x.idx // fpp]
+
+# Applies `policies' ({field: policy}, with the None field for the default)
+# to lazy frames in an event (page), returning a copy of `doc': "full" to
+# read the frames, "drop" to omit them, or n to read every n-th pixel in the
+# last (up to) two dimensions.
+def frames_resolve(doc, policies):
+    data = doc.get("data")
+    if not isinstance(data, dict):
+        return doc
+    def resolve(v, policy):
+        return numpy.asarray(v) if policy == "full" else v[(Ellipsis,) +
+            (slice(None, None, policy),) * min(v.ndim, 2)]
+    ret = {}
+    for k, v in data.items():
+        page = isinstance(v, list)
+        first = v[0] if page and v else v
+        if not isinstance(first, LazyFrame):
+            ret[k] = v
+            continue
+        policy = policies.get(k, policies.get(None, "full"))
+        if policy == "drop":
+            continue
+        if page and policy == "full":
+            frames_load(v)
+        ret[k] = [resolve(x, policy) for x in v] if page else resolve(v, policy)
+    return dict(doc, data = ret)
+
+# Frames wanted together (eg. those in an event page) are read with one
+# refresh and one selection per dataset, along with up to `readahead' later
+# frames which are kept for subsequent events; up to `max_files' SWMR files
+# are kept open across runs.  With `lazy', frames are filled as LazyFrame's.
 class ImageFiller(CallbackBase):
-    def __init__(self):
+    def __init__(self, readahead = 0, max_files = 4, lazy = False):
         super().__init__()
+        self.readahead, self.max_files, self.lazy = readahead, max_files, lazy
         self.fields = []
         self.datasets = {}
         self.cache = {}
+        self.frames = {}
+        self.files = collections.OrderedDict()
+
+    def open(self, path):
+        f = self.files.pop(path, None)
+        if f is None:
+            f = h5py.File(path, "r", swmr = True)
+        self.files[path] = f
+        return f
 
     def descriptor(self, doc):
         for k, v in doc["data_keys"].items():
@@ -71,27 +175,54 @@ class ImageFiller(CallbackBase):
                 self.fields.append(k)
 
     def resource(self, doc):
-        if doc["spec"] == "AD_HDF5_SWMR" and \
-            doc["resource_kwargs"].get("frame_per_point") == 1:
-            f = h5py.File(doc["root"] + doc["resource_path"], "r", swmr = True)
-            self.datasets[doc["uid"]] = f["entry/data/data"]
+        fpp = doc["resource_kwargs"].get("frame_per_point")
+        if doc["spec"] == "AD_HDF5_SWMR" and fpp and fpp >= 1:
+            f = self.open(doc["root"] + doc["resource_path"])
+            self.datasets[doc["uid"]] = f["entry/data/data"], fpp
 
     def datum(self, doc):
-        d = self.datasets.get(doc["resource"])
-        if d:
-            self.cache[doc["datum_id"]] = d, doc["datum_kwargs"]["point_number"]
+        if doc["resource"] in self.datasets:
+            self.cache[doc["datum_id"]] = \
+                doc["resource"], doc["datum_kwargs"]["point_number"]
+
+    def read(self, res, points, ahead = 0):
+        return points_read(*self.datasets[res], points, ahead)
+
+    def fill(self, datum_ids):
+        ret, wanted = [None] * len(datum_ids), collections.OrderedDict()
+        for n, datum_id in enumerate(datum_ids):
+            key = self.cache.pop(datum_id)
+            if self.lazy:
+                d, fpp = self.datasets[key[0]]
+                ret[n] = LazyFrame(d, key[1] * fpp, fpp if fpp > 1 else None)
+            elif key in self.frames:
+                ret[n] = self.frames.pop(key)
+            else:
+                wanted.setdefault(key[0], []).append((n, key[1]))
+        for res, idx in wanted.items():
+            points = sorted(set(i for n, i in idx))
+            frames = self.read(res, points, self.readahead)
+            for n, i in idx:
+                ret[n] = frames[i]
+            for i in points:
+                frames.pop(i)
+            self.frames.update(((res, i), v) for i, v in frames.items())
+        return ret
 
     def event(self, doc):
+        keys = [k for k in self.fields if k in doc["data"]]
+        doc["data"].update(zip(keys,
+            self.fill([doc["data"][k] for k in keys])))
+
+    def event_page(self, doc):
         for k in self.fields:
             if k in doc["data"]:
-                d, i = self.cache.pop(doc["data"][k])
-                d.refresh()
-                doc["data"][k] = d[i]
+                doc["data"][k] = self.fill(doc["data"][k])
 
     def stop(self, doc):
-        for d in self.datasets.values():
-            d.file.close()
-        for obj in [self.fields, self.datasets, self.cache]:
+        while len(self.files) > self.max_files:
+            self.files.popitem(last = False)[1].close()
+        for obj in [self.fields, self.datasets, self.cache, self.frames]:
             obj.clear()
 
 class MyLiveImage(CallbackBase):
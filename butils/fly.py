@@ -1,19 +1,19 @@
-import math
+import collections
+import itertools
+import numpy
+import queue
 import re
+import threading
+import time
+import traceback
 from bluesky import plans
 from bluesky import plan_stubs as bps, preprocessors as bpp
 from .bubo import sseq_disable
 from .panda import seq_disable, seq_outs_not
-from .plans import cfg_trans, motors_get, norm_snake
+from .plans import cfg_diff_wrapper, cfg_trans, motors_get, norm_snake
 
 PANDA_FREQ, DSEQ_DELAY = int(125e6), 9
 
-def split_table(table, max_rows, atom_rows = 1):
-    n = len(table["trigger"])
-    m = max_rows // atom_rows * atom_rows
-    return [{k: v[i * m : (i + 1) * m] for k, v in table.items()}
-        for i in range(math.ceil(n / m))]
-
 def encoder_monitor(panda, inp):
     if not inp.startswith("inenc"):
         return []
@@ -32,7 +32,8 @@ def cfg_inputs(panda, inputs, dseq = False, **kwargs):
         if i < 3:
             cfg += [("seq1.pos%s" % chr(ord("a") + i), inp.upper())]
             if dseq:
-                cfg += [("seq2.pos%s" % chr(ord("a") + i), inp.upper())]
+                cfg += [("%s.pos%s" % (seq, chr(ord("a") + i)), inp.upper())
+                    for seq in panda.dseq.seqs if seq != "seq1"]
         if motor:
             getattr(panda, inp).bind(motor, **kwargs)
     return cfg
@@ -60,13 +61,15 @@ def prep_dseq(panda, outputs, inputs, pgate = True, **kwargs):
     for out in outputs:
         mux, out = out if isinstance(out, tuple) else (out, "a")
         luts[out] = ord(out) - ord("a") + 1
+        if "lut%d" % luts[out] in panda.dseq.luts:
+            raise ValueError("output %s conflicts with the LUTs of dseq" % out)
         cfg.update([(mux, "LUT%d.OUT" % luts[out])])
+    seqs = panda.dseq.seqs
     for out in luts:
-        cfg.update([
-            ("lut%d.inpa" % luts[out], "SEQ1.OUT%s" % out.upper()),
-            ("lut%d.inpb" % luts[out], "SEQ2.OUT%s" % out.upper()),
-            ("lut%d.func" % luts[out], "A|B")
-        ])
+        cfg.update([("lut%d.inp%s" % (luts[out], c),
+            "%s.OUT%s" % (s.upper(), out.upper()))
+            for c, s in zip("abcde", seqs)] +
+            [("lut%d.func" % luts[out], "|".join("ABCDE"[:len(seqs)]))])
     panda.configure(cfg)
 
 def table_warmup():
@@ -105,6 +108,10 @@ def velo_simple(motor, lo, hi, num, duty,
     assert num > 1 and period > 0.0 and velos[1] > 0.0 and pad > 0.0
     return period, velos, pad
 
+def seq_pos(inp):
+    pos = [(p, inp.root.get_input("seq1.pos%s" % p)) for p in "abc"]
+    return [p for p, i in pos if i == inp.prefix][0].upper()
+
 def seq_simple(inp, lo, hi, num, duty, period, pad, snake):
     live, dead = duty * period * PANDA_FREQ, (1.0 - duty) * period * PANDA_FREQ
     assert live >= 1.0 and dead >= 1.0
@@ -112,8 +119,7 @@ def seq_simple(inp, lo, hi, num, duty, period, pad, snake):
         pad *= -1
     scale, offset = inp.scale.get(), inp.offset.get()
     lo, hi, pad = (lo - offset) / scale, (hi - offset) / scale, pad / scale
-    pos = [(p, inp.root.get_input("seq1.pos%s" % p)) for p in "abc"]
-    pos = [p for p, i in pos if i == inp.prefix][0].upper()
+    pos = seq_pos(inp)
     table = dict([
         ("trigger", ["POS%s%s=POSITION" % (pos, op)
             for op in (">><<" if pad > 0.0 else "<<>>")]),
@@ -125,29 +131,163 @@ def seq_simple(inp, lo, hi, num, duty, period, pad, snake):
         table = dict((k, [v[0], v[3]]) for k, v in table.items())
     return {"seq1.repeats": 0, "seq1.table": table}
 
-def table_pcomp(inp, lo, hi, num, duty, period, pad, snake):
-    units, live = num + duty - 1.0, duty * period * PANDA_FREQ
-    assert live >= 1.0 and (1.0 - duty) * period * PANDA_FREQ >= 1.0
+# Rows of the table as a function of their indices, so that long tables can
+# be generated in chunks; rows beyond the first `n' repeat the first ones.
+def table_rows(table):
+    table = dict((k, numpy.asarray(v)) for k, v in table.items())
+    return len(table["trigger"]), lambda idx: \
+        dict((k, v.take(idx, mode = "wrap")) for k, v in table.items())
+
+def table_chunks(rows, total, max_rows):
+    for i in range(0, total, max_rows):
+        yield rows(numpy.arange(i, min(i + max_rows, total)))
+
+# The table builders below return the number of rows per line, and the rows
+# as a function of their indices, which may go beyond the first line.
+def table_base(inp, lo, hi, duty, period, pad, min_period = None):
+    live = duty * period * PANDA_FREQ
+    dead = max(1.0, min_period * PANDA_FREQ - live) \
+        if min_period is not None else (1.0 - duty) * period * PANDA_FREQ
+    assert live >= 1.0 and dead >= 1.0
     if lo > hi:
         pad *= -1
+    pos = seq_pos(inp)
+    triggers = numpy.array(["POS%s%s=POSITION" % (pos, op)
+        for op in (">><<" if pad > 0.0 else "<<>>")])
+    return live, dead, triggers, numpy.array([hi + pad / 2, lo - pad / 2])
+
+def table_pcomp_rows(inp, lo, hi, num, duty,
+    period, pad, snake, min_period = None):
+    units = num + duty - 1.0
+    live, dead, triggers, ends = \
+        table_base(inp, lo, hi, duty, period, pad, min_period)
+    if min_period is None:
+        dead = 1
     scale, offset = inp.scale.get(), inp.offset.get()
-    pos = [(p, inp.root.get_input("seq1.pos%s" % p)) for p in "abc"]
-    pos = [p for p, i in pos if i == inp.prefix][0].upper()
-    poss = [((units - x) * lo + x * hi) / units for x in range(num)], \
-        [(x * lo + (units - x) * hi) / units for x in range(num)]
-    poss = [(x - offset) / scale for x in poss[0] + [hi + pad / 2]] + \
-        [(x - offset) / scale for x in poss[1] + [lo - pad / 2]]
-    pattern = lambda l: [l[0]] * num + [l[1]] + [l[2]] * num + [l[3]]
-    table = dict([
-        ("trigger", pattern(["POS%s%s=POSITION" % (pos, op)
-            for op in (">><<" if pad > 0.0 else "<<>>")])),
-        ("position", poss), ("outa1", pattern([1, 0, 1, 0])),
-        ("time1", pattern([live, 0, live, 0])),
-        ("time2", pattern([1] * 4)), ("repeats", pattern([1] * 4))
-    ] + [(f, pattern([0] * 4)) for f in seq_outs_not(["outa1"])])
-    if not snake:
-        table = dict((k, v[:num] + v[-1:]) for k, v in table.items())
-    return table
+    def rows(idx):
+        x, turn = idx % (num + 1), idx % (num + 1) == num
+        back = (idx // (num + 1)) % 2 if snake else turn.astype("int64")
+        a, b = numpy.where(back, hi, lo), numpy.where(back, lo, hi)
+        poss = numpy.where(turn, ends.take(back),
+            ((units - x) * a + x * b) / units)
+        ones, zeros = [numpy.full(len(idx), v) for v in [1, 0]]
+        return dict([
+            ("trigger", triggers.take(2 * back + turn)),
+            ("position", (poss - offset) / scale), ("outa1", 1 - turn),
+            ("time1", numpy.where(turn, 0, live)),
+            ("time2", numpy.where(turn, 1, dead)), ("repeats", ones)
+        ] + [(f, zeros) for f in seq_outs_not(["outa1"])])
+    return num + 1, rows
+
+def table_pcomp(inp, lo, hi, num, duty, period, pad, snake):
+    n, rows = table_pcomp_rows(inp, lo, hi, num, duty, period, pad, snake)
+    return rows(numpy.arange(n * (2 if snake else 1)))
+
+# `num' fixed-period triggers, regardless of positions, as Immediate rows
+# of up to 65535 repeats (the width of the field in the table).
+def table_time_rows(num, duty, period):
+    live, dead = duty * period * PANDA_FREQ, (1.0 - duty) * period * PANDA_FREQ
+    assert num > 0 and live >= 1.0 and dead >= 1.0
+    n = -(-num // 65535)
+    def rows(idx):
+        ones, zeros = [numpy.full(len(idx), v) for v in [1, 0]]
+        return dict([
+            ("trigger", numpy.full(len(idx), "Immediate")),
+            ("position", zeros),
+            ("repeats", numpy.minimum(65535, num - idx * 65535)),
+            ("time1", numpy.full(len(idx), live)),
+            ("time2", numpy.full(len(idx), dead)), ("outa1", ones)
+        ] + [(f, zeros) for f in seq_outs_not(["outa1"])])
+    return n, rows
+
+# Fixed-period triggers once past `lo'.  A sequencer row cannot be cut
+# short on a position, so instead of being gated off at `hi', the row stops
+# after `num' triggers, which end at `hi' at the velocity from velo_simple();
+# the next row then waits for the turnaround.  A fixed count per line also
+# keeps the frame numbers predictable for the detectors and HDF5Checker.
+def table_gtime_rows(inp, lo, hi, num, duty, period, pad, snake):
+    live, dead, triggers, ends = table_base(inp, lo, hi, duty, period, pad)
+    scale, offset = inp.scale.get(), inp.offset.get()
+    def rows(idx):
+        turn = idx % 2
+        back = (idx // 2) % 2 if snake else turn
+        poss = numpy.where(turn, ends.take(back), numpy.where(back, hi, lo))
+        ones, zeros = [numpy.full(len(idx), v) for v in [1, 0]]
+        return dict([
+            ("trigger", triggers.take(2 * back + turn)),
+            ("position", (poss - offset) / scale),
+            ("repeats", numpy.where(turn, 1, num)),
+            ("time1", numpy.where(turn, 0, live)),
+            ("time2", numpy.where(turn, 1, dead)), ("outa1", 1 - turn)
+        ] + [(f, zeros) for f in seq_outs_not(["outa1"])])
+    return 2, rows
+
+# Fly scan preparations (velocities, padding and sequencer tables) keyed on
+# the scan arguments, keeping the `size' most recently used; entries are
+# dropped when a signal they were computed from changes to a value other than
+# those given in get(), or explicitly with invalidate() (eg. after
+# recalibrating motors).
+class FlyCache(object):
+    def __init__(self, size = 16):
+        self.entries, self.size = collections.OrderedDict(), size
+        self.deps, self.subs = collections.defaultdict(set), {}
+        # changed() runs on CA threads.
+        self.lock = threading.RLock()
+
+    # Computed with the lock held, so that changes meanwhile are checked
+    # against the new entry once it is watched.
+    def get(self, key, fn, deps):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+            ret = self.entries[key] = fn()
+            for sig, vals in deps(*ret):
+                self.watch(sig, key, vals)
+            while len(self.entries) > self.size:
+                self.drop(next(iter(self.entries)))
+            return ret
+
+    def drop(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+            for dep in self.deps.values():
+                dep.difference_update([d for d in dep if d[0] == key])
+
+    def watch(self, sig, key, vals):
+        with self.lock:
+            self.deps[sig].add((key, tuple(vals)))
+            if sig not in self.subs:
+                self.subs[sig] = sig.subscribe(lambda *, value, **kwargs:
+                    self.changed(sig, value), run = False)
+
+    # Runs as a CA callback, so errors only drop the dependent entries.
+    def changed(self, sig, value):
+        if value is None:
+            return
+        with self.lock:
+            for key, vals in list(self.deps[sig]):
+                try:
+                    keep = any(numpy.isclose(value, v)
+                        for v in vals if v is not None)
+                except Exception:
+                    traceback.print_exc()
+                    keep = False
+                if not keep:
+                    self.deps[sig].discard((key, vals))
+                    self.entries.pop(key, None)
+
+    def invalidate(self, *devs):
+        with self.lock:
+            if not devs:
+                self.entries.clear()
+            for sig in list(self.deps):
+                if not devs or any(dev in [sig, sig.parent, sig.root]
+                    for dev in devs):
+                    for key, vals in self.deps.pop(sig):
+                        self.entries.pop(key, None)
+
+flyCache = FlyCache()
 
 def final_config_base(configs):
     cache = [(dev, {k: getattr(dev, k).get() for k in
@@ -222,28 +362,50 @@ def grid_frag(seqs, num, snake, div, scan_gen):
             yield seq, {"num_points": points}, scan_gen(steps)
     return frag_gen()
 
-def frag_simple(panda, *args, pcomp, duty, div = 0, snake_axes = True,
-    period = None, atime = None, velocity = None, pad = None, pos_cache = None):
-    motor, lo, hi, num = args[-4:]
+def frag_prep(panda, motor, lo, hi, num, duty,
+    period, atime, velocity, pad, snake, rows, rows_kwargs):
+    inp = panda.motors[motor]
     period, velos, pad = velo_simple(motor, lo, hi, num, duty,
         period = period, atime = atime, velocity = velocity, pad = pad)
     pad0 = (hi - lo) / (num - 1) * duty / 2
-    snake, div, scan_gen, md = grid_cfg\
-        (args, div, abs(pad0) + pad, snake_axes, pos_cache, velos)
     lo, hi = lo - pad0, hi + pad0
-    if pcomp:
-        seqs = [table_pcomp(panda.motors[motor], l, h, num,
-            duty, period, pad, snake) for l, h in [(lo, hi), (hi, lo)]]
+    if rows:
+        seqs = [rows(inp, l, h, num, duty, period, pad, snake,
+            **rows_kwargs) for l, h in [(lo, hi), (hi, lo)]]
         seqs.append(None)
     else:
-        seqs = [seq_simple(panda.motors[motor], l, h, num,
-            duty, period, pad, snake) for l, h in [(lo, hi), (hi, lo)]]
+        seqs = [seq_simple(inp, l, h, num, duty, period, pad, snake)
+            for l, h in [(lo, hi), (hi, lo)]]
         seqs.append(seq_disable("seq1"))
+    return period, velos, pad, pad0, seqs
+
+def frag_simple(panda, *args, rows, duty, div = 0, snake_axes = True,
+    period = None, atime = None, velocity = None, pad = None,
+    pos_cache = None, rows_kwargs = {}):
+    motor, lo, hi, num = args[-4:]
+    snake = motor in norm_snake(snake_axes, motors_get(args))
+    inp = panda.motors[motor]
+    prep = (panda, motor, lo, hi, num, duty, period, atime,
+        velocity, pad, snake, rows, tuple(sorted(rows_kwargs.items())))
+    key = prep + (inp,) + tuple(panda.get_input("seq1.pos%s" % p)
+        for p in "abc")
+    period, velos, pad, pad0, seqs = flyCache.get(key,
+        lambda: frag_prep(*prep[:-1], rows_kwargs),
+        lambda period, velos, pad, pad0, seqs: [
+            (motor.velocity, velos), (motor.acceleration,
+            [motor.acceleration.get()]), (inp.scale, [inp.scale.get()]),
+            (inp.offset, [inp.offset.get()])
+        ])
+    snake, div, scan_gen, md = grid_cfg\
+        (args, div, abs(pad0) + pad, snake_axes, pos_cache, velos)
     return grid_frag(seqs, num, snake, div, scan_gen), md
 
-def fly_frag(panda, adp, devs, frag_gen, fwraps = [], finals = [], md = None):
+def fly_frag(panda, adp, devs, frag_gen,
+    fwraps = [], finals = [], md = None, pcap = None):
     if callable(fwraps):
         fwraps = [fwraps]
+    if pcap:
+        fwraps, devs = [fwrap_pcap(pcap)] + fwraps, list(devs) + [pcap]
     @bpp.stage_run_decorator([adp] + devs, md = md)
     def inner():
         yield from bps.configure(panda, {"pcap.enable": "ONE"})
@@ -260,11 +422,14 @@ def fly_frag(panda, adp, devs, frag_gen, fwraps = [], finals = [], md = None):
         for plan in finals:
             yield from plan
         yield from bps.configure(panda, {"pcap.enable": "ZERO"})
-    return inner()
+    return cfg_diff_wrapper(inner())
 
-def fly_dfrag(panda, adp, devs, frag_gen, fwraps = [], finals = [], md = None):
+def fly_dfrag(panda, adp, devs, frag_gen,
+    fwraps = [], finals = [], md = None, pcap = None):
     if callable(fwraps):
         fwraps = [fwraps]
+    if pcap:
+        fwraps, devs = [fwrap_pcap(pcap)] + fwraps, list(devs) + [pcap]
     @bpp.stage_run_decorator([adp] + devs, md = md)
     def inner():
         yield from bps.configure\
@@ -272,7 +437,8 @@ def fly_dfrag(panda, adp, devs, frag_gen, fwraps = [], finals = [], md = None):
         for tables, kwargs, scan in frag_gen:
             def plan():
                 yield from bps.configure(panda, {
-                    "dseq.enable": 1, "dseq.tables": tables + [None]
+                    "dseq.enable": 1,
+                    "dseq.tables": itertools.chain(tables, [None])
                 }, action = True)
                 yield from bps.configure(adp, {"cam.acquire": 1}, action = True)
                 yield from bps.configure(panda, {"dseq.poll": 1}, action = True)
@@ -286,7 +452,20 @@ def fly_dfrag(panda, adp, devs, frag_gen, fwraps = [], finals = [], md = None):
         for plan in finals:
             yield from plan
         yield from bps.configure(panda, {"pcap.enable": "ZERO"})
-    return inner()
+    return cfg_diff_wrapper(inner())
+
+# Collects, as one event page per fragment, the positions captured by PCAP
+# for the triggers in the fragment; cf. panda.PandaPcap.
+def fwrap_pcap(flyer):
+    def fwrap(scan, *, num_points, **kwargs):
+        if num_points:
+            flyer.num = num_points
+            yield from bps.kickoff(flyer, wait = True)
+        yield from scan
+        if num_points:
+            yield from bps.complete(flyer, wait = True)
+            yield from bps.collect(flyer)
+    return fwrap
 
 def fwrap_first(plan):
     first = [True]
@@ -333,10 +512,10 @@ def fwrap_adtrig(ads):
 def final_adtrig(ads):
     return final_config_base([(ad, ["cam.num_images"]) for ad in ads])
 
-def fly_simple(panda, adp, dets, *args,
-    configs = {}, md = None, pos_cache = None, **kwargs):
+def fly_simple(panda, adp, dets, *args, configs = {},
+    md = None, pos_cache = None, pcap = None, **kwargs):
     frag_gen, _md = frag_simple(panda, *args,
-        pcomp = False, pos_cache = pos_cache, **kwargs)
+        rows = None, pos_cache = pos_cache, **kwargs)
     motors = motors_get(args)
     devs = [panda, adp] + list(dets) + motors
     _md.update(md or {})
@@ -344,49 +523,281 @@ def fly_simple(panda, adp, dets, *args,
         panda, adp, list(dets) + motors, frag_gen,
         [fwrap_adtrig(dets), fwrap_config(devs, configs)],
         [final_adtrig(dets), final_fly_motor(motors[-1]),
-            final_config(devs, configs)], md = _md
+            final_config(devs, configs)], md = _md, pcap = pcap
     )
 
-def fly_dseq_simple(panda, adp, dets, *args, pcomp,
-    configs = {}, md = None, pos_cache = None, **kwargs):
+# `capture', eg. "Value", overrides how the position of the flying motor is
+# captured (cf. cfg_inputs()) for the duration of the scan.
+def fly_dseq_simple(panda, adp, dets, *args, rows, capture = None,
+    configs = {}, md = None, pos_cache = None, pcap = None, **kwargs):
     frag_gen, _md = frag_simple(panda, *args,
-        pcomp = pcomp, pos_cache = pos_cache, **kwargs)
+        rows = rows, pos_cache = pos_cache, **kwargs)
     motors = motors_get(args)
     devs = [panda, adp] + list(dets) + motors
     _md.update(md or {})
+    pcfg = {} if capture is None else {panda:
+        {"%s.capture" % panda.motors[motors[-1]].prefix.lower(): capture}}
     def dfrag_gen():
         for seq, kwargs, scan in frag_gen:
-            if (not seq if pcomp else seq["seq1.repeats"]):
+            if (not seq if rows else seq["seq1.repeats"]):
                 yield [], kwargs, scan
             else:
-                if pcomp:
-                    repeats = args[-1] + 1
+                if rows:
+                    n, seq = seq
                 else:
-                    seq, repeats = seq["seq1.table"], 2
-                repeats = kwargs["num_points"] // args[-1] * repeats, \
-                    len(seq["trigger"])
-                repeats = repeats[0] // repeats[1], repeats[0] % repeats[1]
-                yield split_table({
-                    k: v * repeats[0] + v[:repeats[1]]
-                    for k, v in seq.items()
-                }, panda.dseq.max_rows()), kwargs, scan
+                    n, seq = 2, table_rows(seq["seq1.table"])[1]
+                yield table_chunks(seq, kwargs["num_points"] // args[-1] *
+                    n, panda.dseq.max_rows()), kwargs, scan
     return fly_dfrag(
         panda, adp, list(dets) + motors, dfrag_gen(),
-        [fwrap_adtrig(dets), fwrap_config(dets, configs)],
+        [fwrap_adtrig(dets), fwrap_config(dets, configs),
+            fwrap_config([panda], pcfg)],
         [final_adtrig(dets), final_fly_motor(motors[-1]),
-            final_config(devs, configs)], md = _md
+            final_config(devs, configs), final_config([panda], pcfg)],
+        md = _md, pcap = pcap
     )
 
 def fly_dsimple(panda, adp, dets, *args,
     configs = {}, md = None, pos_cache = None, **kwargs):
-    return fly_dseq_simple(panda, adp, dets, *args, pcomp = False,
+    return fly_dseq_simple(panda, adp, dets, *args, rows = None,
         configs = configs, md = md, pos_cache = pos_cache, **kwargs)
 
 def fly_pcomp(panda, adp, dets, *args,
     configs = {}, md = None, pos_cache = None, **kwargs):
-    return fly_dseq_simple(panda, adp, dets, *args, pcomp = True,
+    return fly_dseq_simple(panda, adp, dets, *args, rows = table_pcomp_rows,
         configs = configs, md = md, pos_cache = pos_cache, **kwargs)
 
+def wait_dseq(panda, delay = 0.01):
+    while (yield from bps.rd(panda.dseq.state)) == "run":
+        yield from bps.sleep(delay)
+
+# `num' triggers of `period', with no motor (cf. table_time_rows()); the
+# dseq counter is read as the "flying" stream before and after them.
+def fly_tcount(panda, adp, dets, num, *, duty, period,
+    configs = {}, md = None, pcap = None):
+    n, rows = table_time_rows(num, duty, period)
+    devs = [panda, adp] + list(dets)
+    _md = {"num_points": num, "hints": {"progress": ["simple", 2]}}
+    _md.update(md or {})
+    def read():
+        return bps.trigger_and_read([panda.dseq.counter], name = "flying")
+    def scan():
+        yield from read()
+        yield from bps.sleep(num * period)
+        yield from wait_dseq(panda)
+        yield from read()
+    def dfrag_gen():
+        yield table_chunks(rows, n, panda.dseq.max_rows()), \
+            {"num_points": num}, scan()
+    return fly_dfrag(
+        panda, adp, list(dets), dfrag_gen(),
+        [fwrap_adtrig(dets), fwrap_config(dets, configs)],
+        [final_adtrig(dets), final_config(devs, configs)],
+        md = _md, pcap = pcap
+    )
+
+def fly_gtime(panda, adp, dets, *args,
+    configs = {}, md = None, pos_cache = None, **kwargs):
+    return fly_dseq_simple(panda, adp, dets, *args, rows = table_gtime_rows,
+        configs = configs, md = md, pos_cache = pos_cache, **kwargs)
+
+# Position compare, with successive triggers at least `min_period' apart.
+def fly_hpcomp(panda, adp, dets, *args, min_period,
+    configs = {}, md = None, pos_cache = None, **kwargs):
+    return fly_dseq_simple(panda, adp, dets, *args, rows = table_pcomp_rows,
+        rows_kwargs = {"min_period": min_period},
+        configs = configs, md = md, pos_cache = pos_cache, **kwargs)
+
+# Segments of a trajectory, in each of which one axis moves monotonically
+# and triggers the points; steps that fit no segment are repositioning moves.
+def list_segments(points):
+    if len(points) < 2:
+        return numpy.zeros(len(points), dtype = "int64"), \
+            numpy.zeros(1, dtype = "int64")
+    steps = numpy.diff(points, axis = 0)
+    axes = abs(steps).argmax(axis = 1)
+    keys = 2 * axes + (steps[numpy.arange(len(steps)), axes] >= 0)
+    runs = numpy.cumsum(numpy.r_[True, keys[1:] != keys[:-1]]) - 1
+    single = numpy.bincount(runs).take(runs) == 1
+    pkeys = numpy.where(numpy.r_[single, False],
+        numpy.r_[keys[:1], keys], numpy.r_[keys, keys[-1:]])
+    brk = (pkeys[:-1] != pkeys[1:]) | (keys != pkeys[:-1])
+    return pkeys, numpy.r_[0, numpy.flatnonzero(brk) + 1]
+
+def list_cfg(motors, points, duty,
+    period = None, atime = None, pad = None):
+    if (period is None) == (atime is None):
+        raise ValueError("exactly one of period and atime is required")
+    if atime is not None:
+        period = atime / duty
+    keys, starts = list_segments(points)
+    ends = numpy.r_[starts[1:], len(points)] - 1
+    axes, signs = keys // 2, 2 * (keys % 2) - 1
+    velos = numpy.array([m.velocity.get() for m in motors])
+    segs = []
+    for i, j in zip(starts, ends):
+        a, s = axes[i], signs[i]
+        dist = abs(points[j] - points[i])
+        velo = velos.copy()
+        if j > i:
+            velo[a] = dist[a] / (j - i) / period
+            moving = dist > 0.0
+            velo[moving] = velo[a] * dist[moving] / dist[a]
+        p = max(0.5, 2 * motors[a].acceleration.get()) * velo[a] \
+            if pad is None else pad
+        lo, hi = points[i].copy(), points[j].copy()
+        lo[a], hi[a] = lo[a] - s * p, hi[a] + s * p
+        segs.append((a, s, p, lo, hi, velo))
+    assert period > 0.0 and all(v > 0.0 for seg in segs for v in seg[-1])
+    return period, velos, keys, starts, segs
+
+def table_list_pcomp(inps, points, duty, period, keys, starts, segs):
+    live = duty * period * PANDA_FREQ
+    assert live >= 1.0 and (1.0 - duty) * period * PANDA_FREQ >= 1.0
+    scales = numpy.array([inp.scale.get() for inp in inps])
+    offsets = numpy.array([inp.offset.get() for inp in inps])
+    triggers = numpy.array(["POS%s%s=POSITION" % (seq_pos(inp), op)
+        for inp in inps for op in "<>"])
+    n, m = len(points), len(starts)
+    guard = numpy.zeros(n + m, dtype = bool)
+    guard[starts + numpy.arange(m)] = True
+    idx = numpy.cumsum(~guard) - 1
+    idx[guard] = starts
+    axes, sids = keys.take(idx) // 2, numpy.cumsum(guard) - 1
+    # Centre the exposures on the points, as in frag_simple(); guards wait
+    # for the opposite side of the first point of the segment, so that no
+    # point fires during the repositioning move before it.
+    shifts = numpy.array([s * velo[a] * duty * period / 2
+        for a, s, p, lo, hi, velo in segs])
+    poss = points[idx, axes] - shifts.take(sids)
+    poss[guard] = [lo[a] + s * p / 2 for a, s, p, lo, hi, velo in segs]
+    ones, zeros = [numpy.full(n + m, v) for v in [1, 0]]
+    return dict([
+        ("trigger", triggers.take(keys.take(idx) ^ guard)),
+        ("position", (poss - offsets.take(axes)) / scales.take(axes)),
+        ("time1", numpy.where(guard, 0, live)), ("outa1", 1 - guard),
+        ("time2", ones), ("repeats", ones)
+    ] + [(f, zeros) for f in seq_outs_not(["outa1"])])
+
+def list_steps(motors, velos, segs, name = "flying"):
+    def step(pos, velo):
+        for motor, v in zip(motors, velo):
+            yield from bps.configure(motor, {"velocity": v})
+        yield from bps.mv(*[x for mp in zip(motors, pos) for x in mp])
+        yield from bps.trigger_and_read(motors, name = name)
+    yield step(segs[0][3], velos)
+    yield step(segs[0][4], segs[0][5])
+    for a, s, p, lo, hi, velo in segs[1:]:
+        yield step(lo, velos)
+        yield step(hi, velo)
+
+def fly_list_pcomp(panda, adp, dets, *args, duty,
+    configs = {}, md = None, pcap = None, **kwargs):
+    motors = motors_get(args, use_list = True)
+    points = numpy.stack([numpy.asarray(l, dtype = float)
+        for l in args[1::2]], axis = 1)
+    assert 0 < len(motors) <= 3 and len(points)
+    period, velos, keys, starts, segs = \
+        list_cfg(motors, points, duty, **kwargs)
+    table = table_list_pcomp([panda.motors[m] for m in motors],
+        points, duty, period, keys, starts, segs)
+    devs = [panda, adp] + list(dets) + motors
+    _md = {"num_points": len(points),
+        "hints": {"progress": ["simple", len(segs), 2]}}
+    _md.update(md or {})
+    def dfrag_gen():
+        steps = list_steps(motors, velos, segs)
+        yield [], {"num_points": 0}, next(steps)
+        def scan():
+            for step in steps:
+                yield from step
+        yield table_chunks(table_rows(table)[1], len(table["trigger"]),
+            panda.dseq.max_rows()), {"num_points": len(points)}, scan()
+    return fly_dfrag(
+        panda, adp, list(dets) + motors, dfrag_gen(),
+        [fwrap_adtrig(dets), fwrap_config(dets, configs)],
+        [final_adtrig(dets)] + [final_fly_motor(m) for m in motors] +
+            [final_config(devs, configs)], md = _md, pcap = pcap
+    )
+
+# Lines of snaking pcomp rows on the inner axis, each preceded by a guard
+# waiting for the outer axis to enter the window of the line.
+def table_cgrid_rows(oinp, olo, ohi, onum, *args):
+    n, rows = table_pcomp_rows(*args, True)
+    scale, offset = oinp.scale.get(), oinp.offset.get()
+    ostep = (ohi - olo) / (onum - 1)
+    trigger = "POS%s%s=POSITION" % (seq_pos(oinp), ">" if ostep > 0 else "<")
+    def rows2(idx):
+        line, x = idx // (n + 1), idx % (n + 1)
+        inner = rows(line * n + numpy.maximum(x - 1, 0))
+        ones, zeros = [numpy.full(len(idx), v) for v in [1, 0]]
+        guard = dict(inner, trigger = numpy.full(len(idx), trigger),
+            position = (olo + (line - 0.5) * ostep - offset) / scale,
+            time1 = zeros, time2 = ones, outa1 = zeros)
+        return dict((k, numpy.where(x == 0, guard[k], v))
+            for k, v in inner.items())
+    return n + 1, rows2
+
+def wait_pos(motor, pos, sign, delay = 0.01):
+    while sign * ((yield from bps.rd(motor)) - pos) < 0.0:
+        yield from bps.sleep(delay)
+
+def fly_cgrid(panda, adp, dets, *args, duty, div = 0, period = None,
+    atime = None, velocity = None, pad = None, ovelocity = None,
+    configs = {}, md = None, pcap = None):
+    assert len(args) == 8
+    omotor, olo, ohi, onum, imotor, ilo, ihi, inum = args
+    if div and div < onum:
+        raise ValueError("continuous scans cannot be divided")
+    period, velos, pad = velo_simple(imotor, ilo, ihi, inum, duty,
+        period = period, atime = atime, velocity = velocity, pad = pad)
+    pad0 = (ihi - ilo) / (inum - 1) * duty / 2
+    lo, hi = ilo - pad0, ihi + pad0
+    pad1 = abs(pad0) + pad
+    ends = [lo - pad1, hi + pad1] if lo < hi else [lo + pad1, hi - pad1]
+    ostep = (ohi - olo) / (onum - 1)
+    if ovelocity is None:
+        ovelocity = abs(ostep) / (abs(ends[1] - ends[0]) / velos[1] +
+            2 * imotor.acceleration.get())
+    opad = max(0.5, 2 * omotor.acceleration.get()) * ovelocity
+    osign = 1 if ostep > 0 else -1
+    oends = [olo - osign * (abs(ostep) / 2 + opad),
+        ohi + osign * (abs(ostep) / 2 + opad)]
+    n, rows = table_cgrid_rows(panda.motors[omotor], olo, ohi, onum,
+        panda.motors[imotor], lo, hi, inum, duty, period, pad)
+    motors = [omotor, imotor]
+    devs = [panda, adp] + list(dets) + motors
+    _md = {"num_points": onum * inum,
+        "hints": {"progress": ["simple", onum, 2]}}
+    _md.update(md or {})
+    def read():
+        return bps.trigger_and_read(motors, name = "flying")
+    def scan0():
+        yield from bps.mv(omotor, oends[0], imotor, ends[0])
+        yield from read()
+    def scan():
+        yield from bps.configure(imotor, {"velocity": velos[1]})
+        yield from bps.configure(omotor, {"velocity": ovelocity})
+        yield from bps.abs_set(omotor, oends[1], group = "outer")
+        for i in range(onum):
+            yield from wait_pos(omotor, olo + (i - 0.5) * ostep, osign)
+            if i:
+                yield from read()
+            yield from bps.mv(imotor, ends[(i + 1) % 2])
+            yield from read()
+        yield from bps.wait(group = "outer")
+    def dfrag_gen():
+        yield [], {"num_points": 0}, scan0()
+        yield table_chunks(rows, onum * n, panda.dseq.max_rows()), \
+            {"num_points": onum * inum}, scan()
+    return fly_dfrag(
+        panda, adp, list(dets) + motors, dfrag_gen(),
+        [fwrap_adtrig(dets), fwrap_config(dets, configs)],
+        [final_adtrig(dets), final_fly_motor(omotor),
+            final_fly_motor(imotor), final_config(devs, configs)],
+        md = _md, pcap = pcap
+    )
+
 def sseq_base(scomp):
     def seq(bubo):
         while True:
@@ -418,17 +829,84 @@ def scomp_pcomp(dev, lo, hi, num, pad, snake):
             state[0] += state[1]
             return True
         return False
+    # Next position to be passed, and the direction to pass it in.
+    pcomp.dev = dev
+    pcomp.target = lambda: None if not 0 <= state[0] < num \
+        else (lo + sign * state[0] * step, sign * state[1])
     return pcomp
 
-def sfrag_simple(bubo, *args, div = 0,
-    snake_axes = True, pad = None, pos_cache = None):
+# Software pcomp which, instead of firing at the first readback update past
+# a point, fires at the crossing time predicted from the velocity estimated
+# on the (locally timestamped) updates, `lead' seconds early to compensate
+# for the latency of triggering.  Predictions are only made within two
+# update periods, and a point passed unpredicted fires on the next update.
+# The position error at firing is recorded as `bubo_perr'; for predicted
+# firings, the readings are held until the next update, between which and
+# the previous one the position is interpolated (NaN if the scan ends first).
+def sseq_predict(scomp, lead = 0.0):
+    def seq(bubo):
+        prev, velo, period, deadline = None, 0.0, 0.0, None
+        pending = []
+        def schedule():
+            target = scomp.target()
+            if target is None or prev is None or velo * target[1] <= 0.0:
+                return None
+            t = prev[1] + (target[0] - prev[0]) / velo - lead
+            return t if t - prev[1] < 2 * period else None
+        def resolve(cur):
+            for t, data, target in pending:
+                perr = numpy.nan
+                if cur is not None and cur[1] > prev[1]:
+                    pos = prev[0] + (cur[0] - prev[0]) * \
+                        (t + lead - prev[1]) / (cur[1] - prev[1])
+                    perr = (pos - target[0]) * target[1]
+                bubo.append(t, data, perr = perr)
+            pending.clear()
+        def fire(pos = None):
+            target = scomp.target()
+            if not scomp(("input", scomp.dev,
+                prev[0] + velo * (time.time() + lead - prev[1])
+                if pos is None else pos)):
+                return True
+            if pos is not None:
+                return bubo.record(perr = (pos - target[0]) * target[1])
+            ret = bubo.acquire_all()
+            if ret is not None:
+                pending.append(ret + (target,))
+            return ret is not None
+        while True:
+            try:
+                msg = bubo.get(timeout = None if deadline is None
+                    else max(0.0, deadline - time.time()))
+            except queue.Empty:
+                if not fire():
+                    return resolve(None)
+                deadline = schedule()
+                continue
+            if msg[0] == "exit":
+                return resolve(None)
+            if msg[0] != "input" or msg[1] != scomp.dev:
+                continue
+            resolve(msg[2:4])
+            if prev is not None and msg[3] > prev[1]:
+                period = msg[3] - prev[1]
+                velo = (msg[2] - prev[0]) / period
+            prev = msg[2], msg[3]
+            if not fire(msg[2]):
+                return
+            deadline = schedule()
+    return seq
+
+def sfrag_simple(bubo, *args, div = 0, snake_axes = True,
+    pad = None, predict = True, lead = 0.0, pos_cache = None):
     motor, lo, hi, num = args[-4:]
     bubo.inputs.set([motor.readback]).wait()
     if pad is None:
         pad = max(0.5, 2 * motor.acceleration.get()) * motor.velocity.get()
     snake, div, scan_gen, md = grid_cfg\
         (args, div, pad, snake_axes, pos_cache, None)
-    seqs = [sseq_base(scomp_pcomp(motor.readback, l, h, num, pad, snake))
+    sseq = (lambda scomp: sseq_predict(scomp, lead)) if predict else sseq_base
+    seqs = [sseq(scomp_pcomp(motor.readback, l, h, num, pad, snake))
         for l, h in [(lo, hi), (hi, lo)]]
     seqs.append(sseq_disable)
     return grid_frag(seqs, num, snake, div, scan_gen), md
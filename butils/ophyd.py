@@ -1,3 +1,5 @@
+import math
+import numpy
 import threading
 import time
 import traceback
@@ -26,6 +28,31 @@ def para_move(mposs):
         assert fn_wait([m.stop for m in mposs], abort = False)
         raise
 
+# Runs `fn' and waits, on monitor callbacks instead of polling, for `sig' to
+# rise within `timeouts[0]' and then to fall within `timeouts[1]'; returns
+# whether both happened.
+def pulse_wait(sig, fn, timeouts):
+    rise, fall = threading.Event(), threading.Event()
+    def cb(*, value, **kwargs):
+        if value:
+            rise.set()
+        elif rise.is_set():
+            fall.set()
+    sig.subscribe(cb, run = False)
+    try:
+        fn()
+        return rise.wait(timeouts[0]) and fall.wait(timeouts[1])
+    finally:
+        sig.clear_sub(cb)
+
+def bin_image(img, n):
+    h, w = [l // n * n for l in img.shape[-2:]]
+    return img[..., :h, :w].reshape(img.shape[:-2] + (h // n, n, w // n, n))\
+        .mean(axis = (-3, -1), dtype = numpy.float32)
+
+def crop_image(img, roi):
+    return img[..., roi[2] : roi[3], roi[0] : roi[1]] if roi else img
+
 class ThrottleMonitor(Device):
     monitor_period, _monitor_period = Component(AttributeSignal,
         attr = "_monitor_period", kind = "config"), 0.0
@@ -36,6 +63,47 @@ class ThrottleMonitor(Device):
         _timestamp[0] = timestamp
         return True
 
+# Monitored images are cropped to `monitor_roi' ([x0, x1, y0, y1] as in
+# data.roi_sum(), or [] for the whole image) and binned by `monitor_bin', or
+# more if needed for at most `monitor_pixels' (0 for no limit) pixels; if
+# `monitor_rois' is not empty or `monitor_stats' is set, the min/max/sum of
+# the whole image and of each of `monitor_rois' are sent as `*_stats'.
+# The next image after request_full() is sent unreduced.
+class ImageMonitor(ThrottleMonitor):
+    monitor_bin, _monitor_bin = Component(AttributeSignal,
+        attr = "_monitor_bin", kind = "config"), 1
+    monitor_pixels, _monitor_pixels = Component(AttributeSignal,
+        attr = "_monitor_pixels", kind = "config"), 0
+    monitor_roi, _monitor_roi = Component(AttributeSignal,
+        attr = "_monitor_roi", kind = "config"), []
+    monitor_rois, _monitor_rois = Component(AttributeSignal,
+        attr = "_monitor_rois", kind = "config"), []
+    monitor_stats, _monitor_stats = Component(AttributeSignal,
+        attr = "_monitor_stats", kind = "config"), False
+    _monitor_full = False
+
+    def request_full(self):
+        self._monitor_full = True
+
+    def reduce_image(self, name, img):
+        img, ret = numpy.asarray(img), {}
+        if self._monitor_rois or self._monitor_stats:
+            rois = [[]] + list(self._monitor_rois) if img.ndim > 1 else [[]]
+            ret[name + "_stats"] = [[float(x.min()), float(x.max()),
+                float(x.sum())] for x in (crop_image(img, roi)
+                for roi in rois)]
+        if self._monitor_full or img.ndim < 2:
+            self._monitor_full = False
+            ret[name] = img
+            return ret
+        img = crop_image(img, self._monitor_roi)
+        n = self._monitor_bin
+        if self._monitor_pixels:
+            n = max(n, math.ceil(math.sqrt
+                (numpy.prod(img.shape[-2:]) / self._monitor_pixels)))
+        ret[name] = bin_image(img, n) if n > 1 else img
+        return ret
+
 class SimpleDet(Device):
     value = Component(EpicsSignalRO, "")
 
@@ -55,6 +123,7 @@ class MyEpicsMotor(MonitorMotor, EpicsMotor):
         kind = "omitted", auto_monitor = True)
     jog_forward, jog_reverse = [Component(EpicsSignal, suffix,
         kind = "omitted", auto_monitor = True) for suffix in [".JOGF", ".JOGR"]]
+    motor_bdst = Component(EpicsSignalRO, ".BDST", kind = "omitted")
     _homing_direction, _homing_directions = "", ("fwdlimit", "revlimit")
 
     def _move_changed_base(self, timestamp, done, **kwargs):
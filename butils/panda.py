@@ -1,12 +1,20 @@
+import asyncio
 import collections
+import functools
+import h5py
+import logging
 import numpy
+import re
 import queue
 import threading
 import time
 from ophyd import Component, Device, Signal, Kind
+from ophyd.status import Status
 from ophyd.utils.epics_pvs import data_type, data_shape
 from .common import fn_wait
-from .panda_client import PandABlocksClient
+from .panda_client import PandABlocksClient, strip_ok
+
+log = logging.getLogger(__name__)
 
 pandaFields = [
     ("table", [
@@ -75,38 +83,65 @@ pandaExtFields = [
 pandaFields.update(((k, ext), attrs + pandaSubs[ext][1])
     for k, exts, attrs in pandaExtFields for ext in exts)
 
+@functools.lru_cache(maxsize = None)
+def panda_labels_sorted(labels):
+    labels = numpy.array(labels)
+    order = numpy.argsort(labels, kind = "stable")
+    return labels[order], order
+
+def panda_labels_index(labels, l):
+    l = numpy.asarray(l)
+    if l.dtype.kind == "O":
+        return numpy.array([labels.index(x) if isinstance(x, str) else x
+            for x in l], dtype = "int64")
+    elif l.dtype.kind not in "US":
+        return l
+    srt, order = panda_labels_sorted(tuple(labels))
+    i = numpy.searchsorted(srt, l).clip(max = len(srt) - 1)
+    # Mixed lists of labels and indices are coerced into strings by numpy.
+    ret, bad = order.take(i), srt.take(i) != l
+    if bad.any():
+        if not numpy.char.isdigit(l[bad]).all():
+            raise ValueError("invalid label %r" % str(l[bad][0]))
+        ret[bad] = l[bad].astype("int64")
+    return ret
+
 def panda_table_fmt(fields, data):
     n, = set(len(l) for l in data)
-    ret = numpy.zeros((max(f.bits_hi for f in fields) // 32 + 1,
-        n), dtype = "uint32")
+    ret = numpy.zeros((n, max(f.bits_hi for f in fields) // 32 + 1),
+        dtype = "uint32")
     for f, l in zip(fields, data):
         if f.labels:
-            l = [f.labels.index(x) for x in l if isinstance(x, str)]
-        l = numpy.array(l, dtype =
-            "int32" if f.signed else "uint32").view("uint32")
+            l = panda_labels_index(f.labels, l)
+        l = numpy.asarray(l).astype("int64") & \
+            (2 ** (f.bits_hi - f.bits_lo + 1) - 1)
         i, = {f.bits_lo // 32, f.bits_hi // 32}
-        ret[i] |= (l & (2 ** (f.bits_hi - f.bits_lo + 1) - 1)) \
-            << (f.bits_lo % 32)
-    return list(ret.T.reshape((-1,)))
+        ret[:, i] |= (l << (f.bits_lo % 32)).astype("uint32")
+    return ret.reshape((-1,))
 
 def panda_table_fmt_alt(fields, val):
-    val = [val[k.lower()] for k in fields] \
-        if isinstance(val, dict) else list(val)
-    if not all(isinstance(x, int) for x in val):
-        val = panda_table_fmt(fields.values(), val)
-    return val
+    if isinstance(val, dict) or getattr(val, "dtype", None) is not None \
+        and val.dtype.names:
+        val = [val[k.lower()] for k in fields]
+    elif numpy.ndim(val) == 1:
+        return numpy.asarray(val, dtype = "int64").astype("uint32")
+    return panda_table_fmt(fields.values(), val)
 
 def panda_table_unfmt(fields, data):
     ret, m = [], max(f.bits_hi for f in fields) // 32 + 1
-    data = numpy.array(data, dtype = "uint32").reshape((len(data) // m, m)).T
+    data = numpy.asarray(data, dtype = "uint32").reshape((-1, m))
     for f in fields:
         i, = {f.bits_lo // 32, f.bits_hi // 32}
-        l = (data[i] >> (f.bits_lo % 32)) & \
+        l = (data[:, i] >> (f.bits_lo % 32)) & \
             (2 ** (f.bits_hi - f.bits_lo + 1) - 1)
-        l = list(l.view("int32" if f.signed else "uint32"))
+        l = l.view("int32" if f.signed else "uint32")
+        if f.signed and f.bits_hi - f.bits_lo < 31:
+            l = l - ((l >> (f.bits_hi - f.bits_lo)) & 1) * \
+                2 ** (f.bits_hi - f.bits_lo + 1)
         if f.labels:
-            m = len(f.labels)
-            l = [f.labels[i] if i < m else i for i in l]
+            labels, ok = numpy.array(f.labels), l < len(f.labels)
+            l = labels.take(l) if ok.all() else numpy.where(ok,
+                labels.astype("O").take(l, mode = "clip"), l.astype("O"))
         ret.append(l)
     return ret
 
@@ -122,12 +157,36 @@ def panda_attr_get(obj):
 def panda_table_parse(ss):
     return [int(s) for s in ss]
 
+def panda_attr_msg(obj, val):
+    if obj._typ == "table":
+        return obj._client.table_message(obj._block, obj._field, val)
+    return "%s.%s=%s\n" % (obj._block, obj._field, val)
+
+def panda_attr_same(obj, val):
+    if "r" not in obj._mode:
+        return False
+    old = obj._readback
+    if obj._typ == "table":
+        return old is not None and len(old) == len(val) and \
+            numpy.array_equal(old, val)
+    try:
+        return obj._parse(str(val)) == old
+    except ValueError:
+        return False
+
+class PandaConfigError(ValueError):
+    def __init__(self, report):
+        super().__init__("error configuring %s" % ", ".join(
+            "%s (%s)" % (k, v) for k, v in report.items()))
+        self.report = report
+
 class PandaAttr(Signal):
     def __init__(self, target, *, mode, typ, **kwargs):
         if typ == "float":
             kwargs["rtolerance"] = 1e-9
         super().__init__(**kwargs)
         self._client = self.root._client
+        self._mode, self._typ = mode, typ
         self._block, self._field = target.split(".", 1)
         self.enum_strs = tuple()
         if typ == "table":
@@ -254,115 +313,163 @@ class PandaDseqEnable(Signal):
 
 class PandaDseqPoll(Signal):
     def put(self, val):
-        if val:
-            for i in range(int(self.root._poll_period[1] /
-                self.parent._poll_period)):
-                if self.root.pcap.active.value.get():
-                    break
-                time.sleep(self.parent._poll_period)
-            else:
-                super().put(0)
-                return
+        if val and not self.parent._armed.wait(self.root._poll_period[1]):
+            val = 0
         super().put(1 if val else 0)
 
+# Tables may come from any iterable, eg. a generator; they are pulled and
+# formatted by the dseq thread only when a sequencer is to be filled.
 class PandaDseqTables(Signal):
     def put(self, tables):
-        for table in tables:
-            self.parent._q0.put(("table", table))
+        self.parent._q0.put(("tables", iter(tables)))
         super().put("")
 
     def set(self, tables, **kwargs):
-        if not isinstance(tables, list):
+        if tables is None or isinstance(tables, (dict, numpy.ndarray)):
             tables = [tables]
-        val = [panda_table_fmt_alt(self.parent._fields, table)
-            if table is not None else [] for table in tables]
-        return super().set(val, **kwargs)
+        return super().set(tables, **kwargs)
 
     def _set_and_wait(self, value, timeout, **kwargs):
         self.put(value)
 
 class PandaDseq(Device):
-    _poll_period = 0.01
+    _poll_period = 0.002
     state = Component(Signal, value = "idle", kind = "normal")
     counter = Component(Signal, value = 0, kind = "normal")
+    # Tables loaded less than `margin_warn' seconds before their start are
+    # counted in `margin_late'; `margin_min' is the smallest margin so far,
+    # and the latest `margins.maxlen' margins are kept in `margins'.
+    margin_warn = Component(Signal, value = 0.1, kind = "config")
+    margin_min = Component(Signal, value = numpy.inf, kind = "omitted")
+    margin_late = Component(Signal, value = 0, kind = "omitted")
     enable = Component(PandaDseqEnable, value = 0, kind = "config")
     poll = Component(PandaDseqPoll, value = 0, kind = "omitted")
     tables = Component(PandaDseqTables, value = "", kind = "omitted")
 
-    def __init__(self, *args, fields, **kwargs):
+    # `seqs' is the number of sequencers in the ring, or their indices; each
+    # SEQn is gated by SRGATEn, which is set by one of the last LUTs.
+    def __init__(self, *args, fields, seqs = 2, **kwargs):
         super().__init__(*args, **kwargs)
         self.state._metadata["write_access"] = False
         self.counter._metadata["write_access"] = False
         self._q0 = self._q1 = self._subs = None
         self._fields, self._end = fields, False
-        self._idx, self._max = 0, -1
+        self._idx, self._max, self._tfills = 0, -1, []
+        self.margins = collections.deque(maxlen = 4096)
+        self._armed, self._poll_stop = threading.Event(), None
+        seqs = range(1, seqs + 1) if isinstance(seqs, int) else seqs
+        assert len(seqs) >= 2
+        self.seqs = ["seq%d" % i for i in seqs]
+        self.srgates = ["srgate%d" % i for i in seqs]
+        self.luts = ["lut%d" % i for i in range(9 - len(seqs), 9)]
+
+    def _blocks(self, names):
+        return [getattr(self.root, name) for name in names]
 
     def make_cfg(self):
-        ret = {
-            "pcap.enable": "ZERO",
-            "pcap.trig_edge": "Falling",
-            "seq1.enable": "SRGATE1.OUT",
-            "seq2.enable": "SRGATE2.OUT",
-            "lut7.func": "A&~B",
-            "lut8.func": "A&~B",
-            "lut7.inpa": "PCAP.ACTIVE",
-            "lut8.inpa": "PCAP.ACTIVE",
-            "lut7.inpb": "SEQ2.ACTIVE",
-            "lut8.inpb": "SEQ1.ACTIVE",
-            "srgate1.enable": "ZERO",
-            "srgate2.enable": "ZERO",
-            "srgate1.set_": "LUT7.OUT",
-            "srgate2.set_": "LUT8.OUT",
-            "srgate1.set_edge": "Rising",
-            "srgate2.set_edge": "Rising",
-            "srgate1.when_disabled": "Set output low",
-            "srgate2.when_disabled": "Set output low"
-        }
-        ret.update(seq_disable("seq1"))
-        ret.update(seq_disable("seq2"))
+        seqs, srgates, luts = self.seqs, self.srgates, self.luts
+        prevs = seqs[-1:] + seqs[:-1]
+        ret = [("pcap.enable", "ZERO"), ("pcap.trig_edge", "Falling")]
+        ret += [("%s.enable" % s, "%s.OUT" % g.upper())
+            for s, g in zip(seqs, srgates)]
+        ret += [("%s.func" % l, "A&~B") for l in luts]
+        ret += [("%s.inpa" % l, "PCAP.ACTIVE") for l in luts]
+        ret += [("%s.inpb" % l, "%s.ACTIVE" % p.upper())
+            for l, p in zip(luts, prevs)]
+        for f, val in [("enable", "ZERO"), ("set_", None),
+            ("set_edge", "Rising"), ("when_disabled", "Set output low")]:
+            ret += [("%s.%s" % (g, f), val or "%s.OUT" % l.upper())
+                for g, l in zip(srgates, luts)]
+        ret = dict(ret)
+        for s in seqs:
+            ret.update(seq_disable(s))
         return ret
 
     def max_rows(self):
-        return self.root.seq1.table.max_length._readback // \
+        return self._blocks(self.seqs)[0].table.max_length._readback // \
             (max(f.bits_hi for f in self._fields.values()) // 32 + 1)
 
     def _stage(self):
         # This also ensures the latest state of these values is retrieved,
         # preventing spurious edges (note each value gets queried twice)
         # appearing on the later subscriptions because of an untimely poll.
+        seqs = self._blocks(self.seqs)
         assert not any(block.active.value.get() or block.active.value.get()
-            for block in [self.root.seq1, self.root.seq2, self.root.pcap])
+            for block in seqs + [self.root.pcap])
         Signal.put(self.poll, 0)
         Signal.put(self.counter, 0, force = True)
+        self.margins.clear()
+        Signal.put(self.margin_min, numpy.inf, force = True)
+        Signal.put(self.margin_late, 0, force = True)
         Signal.put(self.state, "run", force = True)
+        self._armed.clear()
         table = table_disable()
-        self.root.configure({
-            "seq1.table": table,
-            "seq2.table": table,
-            "srgate1.enable": "ONE",
-            "srgate2.enable": "ONE",
-            "srgate1.force_set": "",
-            "srgate2.force_set": ""
-        }, action = True)
+        self.root.configure(dict(
+            [("%s.table" % s, table) for s in self.seqs] +
+            [("%s.enable" % g, "ONE") for g in self.srgates] +
+            [("%s.force_set" % g, "") for g in self.srgates]
+        ), action = True)
         self._q0, self._q1 = queue.Queue(), collections.deque()
         self._subs = [block.active.value.subscribe((lambda i: (
-            lambda *, value, old_value, **kwargs:
-            not value and old_value and self._q0.put(("inactive", i))
-        ))(i)) for i, block in enumerate([self.root.seq1, self.root.seq2])]
+            lambda *, value, old_value, **kwargs: not value and old_value
+                and self._q0.put(("inactive", i, time.monotonic()))
+        ))(i)) for i, block in enumerate(seqs)]
         self._subs.append(self.root.pcap.active.value.subscribe(
-            lambda *, value, old_value, **kwargs:
-            value and not old_value and self._q0.put(("inactive", -1))
+            lambda *, value, old_value, **kwargs: value and not old_value
+                and (self._armed.set(), self._q0.put
+                    (("inactive", -1, time.monotonic())))
         ))
-        self._end, self._idx, self._max = False, 0, -1
+        self._end, self._idx, self._max, self._tfills = False, 0, -1, []
+        self._start_poll()
         threading.Thread(target = self._run, daemon = True).start()
 
+    def _start_poll(self):
+        # Only the ACTIVE bits are polled, much faster than with `*CHANGES?';
+        # PandaRoot leaves them alone meanwhile, so that the order of updates
+        # is kept.  A last poll is done after handing them back.
+        attrs = [block.active.value
+            for block in self._blocks(self.seqs + ["pcap"])]
+        msgs = ["%s.%s?\n" % (a._block, a._field) for a in attrs]
+        self.root._polled.update(attrs)
+        # Each poll has its own stop event and queue, so that a poll not yet
+        # stopped when the next one starts does not linger into that.
+        stop, q0 = threading.Event(), self._q0
+        self._poll_stop = stop
+        def poll():
+            try:
+                while True:
+                    t, polling = time.monotonic(), not stop.is_set()
+                    if not polling:
+                        self.root._polled.difference_update(attrs)
+                    resps = self.root._client.send_recv_all(msgs)
+                    for a, resp in zip(attrs, resps):
+                        if isinstance(resp, Exception):
+                            raise resp
+                        a._update(strip_ok(resp))
+                    if not polling:
+                        return
+                    time.sleep(max(0.0,
+                        self._poll_period - (time.monotonic() - t)))
+            except Exception as e:
+                self.root._polled.difference_update(attrs)
+                if not stop.is_set():
+                    q0.put(("error", e))
+                raise
+        threading.Thread(target = poll, daemon = True).start()
+
     def _unstage(self, ret):
         if self._subs:
-            for sub, block in zip(self._subs, [
-                self.root.seq1, self.root.seq2, self.root.pcap
-            ]):
+            for sub, block in \
+                zip(self._subs, self._blocks(self.seqs + ["pcap"])):
                 block.active.value.unsubscribe(sub)
-        self.root.configure({"srgate1.enable": "ZERO", "srgate2.enable": "ZERO"})
+        if self._poll_stop:
+            self._poll_stop.set()
+        self.root.configure\
+            (dict(("%s.enable" % g, "ZERO") for g in self.srgates))
+        if self.margin_late.get():
+            log.warning("%s: %d tables loaded less than %.3f s before their"
+                " start, down to %.3f s", self.name, self.margin_late.get(),
+                self.margin_warn.get(), self.margin_min.get())
         Signal.put(self.state, ret, force = True)
         Signal.put(self.poll, 0)
         Signal.put(self.enable, 0)
@@ -374,45 +481,80 @@ class PandaDseq(Device):
                 msg = self._q0.get()
                 if msg[0] == "exit":
                     break
-                elif msg[0] == "table":
+                elif msg[0] == "tables":
                     self._fill0(msg[1])
                 elif msg[0] == "inactive":
-                    self._fill1(msg[1])
+                    self._fill1(*msg[1:])
+                elif msg[0] == "error":
+                    raise msg[1]
             self._unstage("idle")
         except:
             self._unstage("error")
             raise
 
+    def _next(self):
+        while self._q1:
+            table = next(self._q1[0], self)
+            if table is self:
+                self._q1.popleft()
+            elif table is None:
+                self._end = True
+                return []
+            else:
+                return panda_table_fmt_alt(self._fields, table)
+        return None
+
     def _fill(self, table):
-        if not table:
+        assert table is not None
+        if not len(table):
             self._max = self._idx
             return
-        i = self._idx % 2
-        getattr(self.root, "srgate%d" % (1 + i)).force_rst.value.put("")
-        getattr(self.root, "seq%d" % (1 + i)).table.value.put(table)
+        i = self._idx % len(self.seqs)
+        getattr(self.root, self.srgates[i]).force_rst.value.put("")
+        getattr(self.root, self.seqs[i]).table.value.put(table)
+        self._tfills.append(time.monotonic())
         self._idx += 1
 
-    def _fill0(self, table):
+    def _fill0(self, tables):
         assert not self._end
-        if not table:
-            self._end = True
-        if self._idx:
-            self._q1.append(table)
-        else:
-            self._fill(table)
-
-    def _fill1(self, i):
+        self._q1.append(tables)
+        if not self._idx:
+            table = self._next()
+            if table is not None:
+                self._fill(table)
+
+    # Once PCAP is armed, all sequencers but the first one get filled; later
+    # each one is refilled as soon as it becomes inactive.
+    def _fill1(self, i, t):
+        m = len(self.seqs)
         if i < 0:
             assert self._idx == 1
+            fills = m - 1
         else:
             n = self.counter.get()
-            assert i >= 0 and n % 2 == i
+            assert i >= 0 and n % m == i
             Signal.put(self.counter, n + 1, force = True)
-        i = self._idx % 2
-        if self._max < 0:
-            self._fill(self._q1.popleft())
-        if self._max < 0 or self.counter.get() < self._max - 1:
-            assert getattr(self.root, "seq%d" % (2 - i)).active.value.get()
+            self._margin(n + 1, t)
+            fills = 1
+        for j in range(fills):
+            if self._max < 0:
+                self._fill(self._next())
+        n = self.counter.get()
+        if self._max < 0 or n < self._max - 1:
+            assert getattr(self.root, self.seqs[n % m]).active.value.get()
+
+    # Time between loading a table and its start, ie. the headroom left
+    # before the sequencers would have underflowed.
+    def _margin(self, k, t):
+        if k >= len(self._tfills):
+            return
+        margin = t - self._tfills[k]
+        self.margins.append(margin)
+        if margin < self.margin_min.get():
+            Signal.put(self.margin_min, margin, force = True)
+        if margin < self.margin_warn.get():
+            Signal.put(self.margin_late,
+                self.margin_late.get() + 1, force = True)
 
 class PandaRoot(Device):
     _poll_period = (1.0, 0.1)
@@ -420,18 +562,21 @@ class PandaRoot(Device):
     def __init__(self, client, *, name, omcs, **kwargs):
         self._client = client
         super().__init__(name = name, **kwargs)
-        self.motors = {}
+        self.motors, self.config_report, self._polled = {}, {}, set()
         self._romits, self._muxes, self._caps = \
             [[getattr(self, a) for a in l] for l in omcs]
         self._poll_active, self._poll_event = False, threading.Event()
+        self._poll_wake = self._poll_event.set
         self.pcap.active.value.subscribe(lambda *, value, old_value, **kwargs:
-            value and not old_value and self._poll_event.set())
+            value and not old_value and self._poll_wake())
         self._update()
         self._update_romits()
         self._start_poll()
 
-    def _update(self):
-        for k, v in self._client.get_changes():
+    def _update(self, changes = None):
+        if changes is None:
+            changes = self._client.get_changes()
+        for k, v in changes:
             if k[0] == "*":
                 continue
             k = k.lower().split(".")
@@ -439,12 +584,17 @@ class PandaRoot(Device):
                 assert len(k) == 2
                 k.append("value")
             k[1] = panda_field_fmt(k[1])
-            getattr(self, ".".join(k))._update(v)
+            attr = getattr(self, ".".join(k))
+            if attr not in self._polled:
+                attr._update(v)
 
     def _update_romits(self):
         assert fn_wait([a.get for a in self._romits])
 
     def _start_poll(self):
+        # With an asyncio client, poll on its loop instead of in a thread.
+        if getattr(self._client, "loop", None):
+            return self._start_apoll()
         def poll():
             self._poll_active = True
             while True:
@@ -458,6 +608,30 @@ class PandaRoot(Device):
                     raise
         threading.Thread(target = poll, daemon = True).start()
 
+    def _start_apoll(self):
+        loop = self._client.loop
+        async def poll():
+            event = asyncio.Event()
+            self._poll_wake = lambda: loop.call_soon_threadsafe(event.set)
+            self._poll_active = True
+            try:
+                while True:
+                    try:
+                        await asyncio.wait_for(event.wait(), self._poll_period
+                            [self.pcap.active.value._readback])
+                    except asyncio.TimeoutError:
+                        pass
+                    event.clear()
+                    # Subscribers may call the synchronous client API,
+                    # which would deadlock if run on the loop.
+                    await loop.run_in_executor(None,
+                        self._update, await self._client.aget_changes())
+            except:
+                self._poll_active = False
+                raise
+        # Cancelled by the client when it stops; failures are logged there.
+        self._poll_future = self._client.run_task(poll())
+
     def clear_muxes(self):
         assert fn_wait([(lambda a: lambda: a.put("ZERO"))(a)
             for a in self._muxes], abort = False)
@@ -504,8 +678,46 @@ class PandaRoot(Device):
             ((k.replace(".", "_"), ret[k]) for k in ret)
         return self._config_cache[int(not dot)].copy()
 
+    def configure_bulk(self, cfg, action = False, fast = True):
+        # Writes to PandA fields are pipelined in a single burst, in the order
+        # given, skipping those already matching the polled readbacks; other
+        # entries (eg. `dseq.*') flush the burst and go through ophyd.
+        report, pending = collections.OrderedDict(), []
+        def flush():
+            resps = self._client.send_recv_all([msg for _, _, _, msg in pending])
+            for (k, obj, val, _), resp in zip(pending, resps):
+                if isinstance(resp, Exception):
+                    report[k] = str(resp)
+                elif resp != "OK":
+                    report[k] = "expected OK, got %r" % resp
+                else:
+                    Signal.put(obj, val)
+            pending.clear()
+
+        for k, val in cfg.items():
+            obj = getattr(self, k)
+            if isinstance(obj, PandaField):
+                obj = getattr(obj, "value", obj)
+            if not isinstance(obj, PandaAttr):
+                flush()
+                super().configure({k: val}, action = action, fast = fast)
+                continue
+            if not (action or obj.kind & Kind.config):
+                raise ValueError("%s is not a configuration attribute" % k)
+            if obj._typ == "table":
+                val = panda_table_fmt_alt(obj.parent.fields._readback, val)
+            if not panda_attr_same(obj, val):
+                pending.append((k, obj, val, panda_attr_msg(obj, val)))
+        flush()
+        return report
+
     def configure(self, cfg, action = False, fast = True):
-        return super().configure(cfg, action = action, fast = fast)
+        old = self.read_configuration()
+        self.config_report = self.configure_bulk\
+            (cfg, action = action, fast = fast)
+        if self.config_report:
+            raise PandaConfigError(self.config_report)
+        return old, self.read_configuration()
 
 def panda_typ_fmt(s):
     return s.replace("_", "").title()
@@ -537,11 +749,11 @@ def panda_fclasses():
         ret[f] = cls, mode, enums, romit, tbmo
     return ret
 
-def PandaDevice(hostname = "localhost",
-    port = 8888, *, name, inherit = None, **kwargs):
+def PandaDevice(hostname = "localhost", port = 8888, *, name, inherit = None,
+    client_cls = PandABlocksClient, dseqs = 2, **kwargs):
     if not inherit:
         inherit = PandaRoot,
-    client = PandABlocksClient(hostname, port)
+    client = client_cls(hostname, port)
     client.start()
     capbits = client.get_pcap_bits_fields()
     fclasses, blocks, omcd = panda_fclasses(), [], {}
@@ -583,6 +795,131 @@ def PandaDevice(hostname = "localhost",
     blocks = [(k + idx, block) for k, n, block in blocks for idx in idxs(n)]
     return type("PandaDevice", inherit, dict(
         [(k.lower(), Component(block, k)) for k, block in blocks] +
-        [("dseq", Component(PandaDseq, fields = sfields))]
+        [("dseq", Component(PandaDseq, fields = sfields, seqs = dseqs))]
     ))(client, name = name, omcs = omcs, **kwargs)
 
+def pcap_key(s):
+    return re.sub(r"[^0-9a-z]+", "_", s.lower()).strip("_")
+
+# Flyer for the PCAP captures written by the PandA areaDetector driver into
+# its HDF5 file, collected once per fragment as an event page; rows are
+# joined to the frames of other detectors triggered by PCAP by `*_index'.
+# `num' is the number of triggers expected in the current fragment, and
+# complete() fails if no new frame arrives for `timeout' seconds before them.
+class PandaPcap(object):
+    def __init__(self, panda, adp, *,
+        name = None, stream = "pcap", timeout = 10.0):
+        self.panda, self.adp, self.stream = panda, adp, stream
+        self.name = name or panda.name + "_pcap"
+        self.parent, self.timeout = None, timeout
+        self.path, self.file = None, None
+        self.rows = self.start = self.num = self.counter = 0
+
+    def columns(self):
+        ret = collections.OrderedDict()
+        for a in self.panda._caps:
+            if a._readback == "No":
+                continue
+            field = "%s.%s" % (a._block, a._field.rsplit(".", 1)[0])
+            for word in a._readback.split():
+                key = pcap_key("%s.%s" % (field, word))
+                ret[key] = ("%s_%s" % (self.panda.name, key),
+                    "PANDA:%s.%s" % (field, word))
+        return ret
+
+    def describe_collect(self):
+        keys = collections.OrderedDict([("%s_index" % self.name,
+            {"source": "PANDA:PCAP", "dtype": "integer", "shape": []})])
+        keys.update((name, {"source": src, "dtype": "number", "shape": []})
+            for name, src in self.columns().values())
+        return {self.stream: keys}
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+        self.path, self.file, self.rows = None, None, 0
+
+    def stage(self):
+        self.close()
+        return [self]
+
+    def unstage(self):
+        self.close()
+        return [self]
+
+    def kickoff(self):
+        path = self.adp.hdf1.full_file_name.get()
+        if path != self.path:
+            self.close()
+            self.path = path
+        self.start = self.rows
+        self.counter = self.adp.hdf1.array_counter.get()
+        st = Status(obj = self)
+        st.set_finished()
+        return st
+
+    def complete(self):
+        # Done when the file or the frame counter has all rows of the
+        # fragment; the deadline is pushed back by every new frame.
+        st = Status(obj = self)
+        def wait():
+            cnt, t = self.counter, time.monotonic()
+            try:
+                while True:
+                    prev, cnt = cnt, self.adp.hdf1.array_counter.get()
+                    if cnt - self.counter >= self.num or \
+                        self.file_rows() >= self.start + self.num:
+                        break
+                    if cnt != prev:
+                        t = time.monotonic()
+                    elif time.monotonic() - t > self.timeout:
+                        raise TimeoutError("%s: %d of %d frames after "
+                            "%g s without new ones" % (self.name,
+                            cnt - self.counter, self.num, self.timeout))
+                    time.sleep(0.1)
+            except Exception as e:
+                st.set_exception(e)
+            else:
+                st.set_finished()
+        threading.Thread(target = wait, daemon = True).start()
+        return st
+
+    def datasets(self):
+        cols, ret = self.columns(), {}
+        def visit(name, obj):
+            key = pcap_key(name.rsplit("/", 1)[-1])
+            if isinstance(obj, h5py.Dataset) and key in cols:
+                obj.refresh()
+                ret[cols[key][0]] = obj
+        if self.file is None:
+            self.file = h5py.File(self.path, "r", swmr = True)
+        self.file.visititems(visit)
+        return ret
+
+    # The file only appears with the first frame.
+    def file_rows(self):
+        try:
+            return min([len(d) for d in self.datasets().values()], default = 0)
+        except OSError:
+            return 0
+
+    def read_rows(self):
+        data = dict((k, numpy.asarray(d[self.start : self.start + self.num])
+            .ravel()) for k, d in self.datasets().items())
+        n = min([len(v) for v in data.values()], default = 0)
+        data = dict((k, v[:n]) for k, v in data.items())
+        data["%s_index" % self.name] = numpy.arange(self.start, self.start + n)
+        self.rows = self.start + n
+        return n, data
+
+    def collect_pages(self):
+        n, data = self.read_rows()
+        if not n:
+            return
+        now = time.time()
+        yield {
+            "time": [now] * n,
+            "data": dict((k, v.tolist()) for k, v in data.items()),
+            "timestamps": dict((k, [now] * n) for k in data)
+        }
+
@@ -1,5 +1,8 @@
+import asyncio
+import concurrent.futures
 import logging
-from collections import OrderedDict, namedtuple
+import threading
+from collections import OrderedDict, deque, namedtuple
 
 # Create a module level logger
 log = logging.getLogger(__name__)
@@ -68,6 +71,10 @@ class PandABlocksClient:
                 f"Can't connect to '{self.hostname}:{self.port}', "
                 "did all services on the PandA start correctly?"
             ) from e
+        # Pipelined small requests would otherwise be held back by Nagle
+        from socket import IPPROTO_TCP, TCP_NODELAY
+
+        self._socket.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
 
         self._send_spawned = spawn(self._send_loop)
         self._recv_spawned = spawn(self._recv_loop)
@@ -157,27 +164,30 @@ class PandABlocksClient:
         lines_iterator = self._get_lines()
         while True:
             try:
-                line = next(lines_iterator)
-                if self._is_multiline is None:
-                    self._is_multiline = line.startswith("!") or line == "."
-                if line.startswith("ERR"):
-                    self._respond(ValueError(line))
-                elif self._is_multiline:
-                    if line == ".":
-                        self._respond(self._completed_response_lines)
-                    else:
-                        assert (
-                            line[0] == "!"
-                        ), f"Multiline response {repr(line)} doesn't start with !"
-                        self._completed_response_lines.append(line[1:])
-                else:
-                    self._respond(line)
+                self._handle_line(next(lines_iterator))
             except StopIteration:
                 return
             except Exception:
                 log.exception("Exception receiving message")
                 raise
 
+    def _handle_line(self, line):
+        """Accumulate a received line, responding once a response is complete"""
+        if self._is_multiline is None:
+            self._is_multiline = line.startswith("!") or line == "."
+        if line.startswith("ERR"):
+            self._respond(ValueError(line))
+        elif self._is_multiline:
+            if line == ".":
+                self._respond(self._completed_response_lines)
+            else:
+                assert (
+                    line[0] == "!"
+                ), f"Multiline response {repr(line)} doesn't start with !"
+                self._completed_response_lines.append(line[1:])
+        else:
+            self._respond(line)
+
     def _get_block_numbers(self):
         block_numbers = OrderedDict()
         for line in self.send_recv("*BLOCKS?\n"):
@@ -292,16 +302,20 @@ class PandABlocksClient:
             bits[k + ".CAPTURE"] = self.recv(queue)
         return bits
 
-    def get_changes(self, include_errors=False):
-        table_queues = {}
-        for line in self.send_recv("*CHANGES?\n"):
+    def _parse_changes(self, lines, include_errors):
+        """Split the lines of a *CHANGES? response
+
+        Returns:
+            tuple: ([(field, value)], [table_field]), where the values of the
+            table fields still need to be requested separately
+        """
+        changes, tables = [], []
+        for line in lines:
             if "=" in line:
                 field, val = line.split("=", 1)
             elif line[-1] == "<":
                 # table
-                field = line[:-1]
-                val = None
-                table_queues[field] = self.send(f"{field}?\n")
+                tables.append(line[:-1])
                 continue
             elif line.endswith("(error)"):
                 if include_errors:
@@ -312,7 +326,15 @@ class PandABlocksClient:
             else:
                 log.warning("Can't parse line %r of changes", line)
                 continue
-            yield field, val
+            changes.append((field, val))
+        return changes, tables
+
+    def get_changes(self, include_errors=False):
+        changes, tables = self._parse_changes(
+            self.send_recv("*CHANGES?\n"), include_errors
+        )
+        table_queues = self.parameterized_send("%s?\n", tables)
+        yield from changes
         for field, q in table_queues.items():
             yield field, self.recv(q)
 
@@ -369,10 +391,236 @@ class PandABlocksClient:
             else:
                 assert resp == "OK", f"Expected OK, got {resp!r}"
 
-    def set_table(self, block, field, int_values):
+    def send_recv_all(self, messages, timeout=10.0):
+        """Pipeline messages to a PandABox and wait for all the responses
+
+        Args:
+            messages (list): The messages to send, in order
+            timeout (float): How long to wait for each response
+
+        Returns:
+            list: The response to each message, or the ValueError it raised
+        """
+        response_queues = [self.send(message) for message in messages]
+        responses = []
+        for response_queue in response_queues:
+            try:
+                responses.append(self.recv(response_queue, timeout))
+            except ValueError as e:
+                responses.append(e)
+        return responses
+
+    @staticmethod
+    def table_message(block, field, int_values):
+        if hasattr(int_values, "tolist"):
+            int_values = int_values.tolist()
         lines = [f"{block}.{field}<\n"]
         lines += [f"{int_value}\n" for int_value in int_values]
         lines += ["\n"]
-        resp = self.send_recv("".join(lines))
+        return "".join(lines)
+
+    def set_table(self, block, field, int_values):
+        resp = self.send_recv(self.table_message(block, field, int_values))
         assert resp == "OK", f"Expected OK, got {resp!r}"
 
+
+
+class AsyncioPandABlocksClient(PandABlocksClient):
+    """PandABlocksClient whose socket is serviced by an asyncio event loop
+
+    Instead of a send and a recv thread with a queue per request, messages are
+    written straight to an asyncio stream and responses are routed to futures
+    held in a deque, in the order the requests were sent.  The synchronous API
+    of PandABlocksClient is kept as thin wrappers, so it can be used anywhere
+    the threaded client is; coroutines running in ``self.loop`` should use the
+    ``a``-prefixed variants instead, as the synchronous ones would deadlock.
+
+    If no loop is given, start() runs a private one in a daemon thread; a
+    loop passed in must already be running in another thread, unless the
+    client is driven with ``await client.connect()`` from inside that loop.
+    """
+
+    def __init__(self, hostname="localhost", port=8888, loop=None):
+        super().__init__(hostname, port)
+        self.loop = loop
+        self._loop_thread = None
+        self._reader = None
+        self._writer = None
+        self._recv_task = None
+        self._response_futures = None
+        self._tasks = set()
+
+    def start(self, spawn=None, socket_cls=None):
+        assert not self.started, "Client already started"
+        if self.loop is None:
+            self.loop = asyncio.new_event_loop()
+            self._loop_thread = threading.Thread(
+                target=self.loop.run_forever, daemon=True
+            )
+            self._loop_thread.start()
+        self.run_coroutine(self.connect()).result()
+
+    def stop(self):
+        self.run_coroutine(self.close()).result()
+        if self._loop_thread is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._loop_thread.join()
+            self._loop_thread = None
+            self.loop.close()
+            self.loop = None
+
+    def run_coroutine(self, coro):
+        """Schedule a coroutine on the client's loop from another thread
+
+        Returns:
+            concurrent.futures.Future: Resolves to the result of the coroutine
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run_task(self, coro):
+        """Like run_coroutine(), for a long-running coroutine that close()
+        cancels; its failure (other than cancellation) is logged
+
+        Returns:
+            concurrent.futures.Future: Resolves to the result of the coroutine
+        """
+
+        async def task():
+            current = asyncio.current_task()
+            self._tasks.add(current)
+            try:
+                return await coro
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("Exception in client task")
+                raise
+            finally:
+                self._tasks.discard(current)
+
+        return self.run_coroutine(task())
+
+    async def connect(self):
+        try:
+            self._reader, self._writer = await asyncio.open_connection(
+                self.hostname, self.port
+            )
+        except OSError as e:
+            raise ConnectionError(
+                f"Can't connect to '{self.hostname}:{self.port}', "
+                "did all services on the PandA start correctly?"
+            ) from e
+        self._response_futures = deque()
+        self._completed_response_lines = []
+        self._is_multiline = None
+        self._recv_task = asyncio.get_running_loop().create_task(
+            self._arecv_loop()
+        )
+        self.started = True
+
+    async def close(self):
+        assert self.started, "Client not started"
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._writer.close()
+        try:
+            await self._writer.wait_closed()
+        except Exception:
+            pass
+        await asyncio.gather(self._recv_task, return_exceptions=True)
+        self._reader = self._writer = self._recv_task = None
+        self.started = False
+
+    async def _arecv_loop(self):
+        """Service the stream reader, resolving the futures of responses"""
+        buf = ""
+        try:
+            while True:
+                rx = await self._reader.read(4096)
+                if not rx:
+                    break
+                lines = (buf + rx.decode("utf-8")).split("\n")
+                buf = lines.pop()
+                for line in lines:
+                    self._handle_line(line)
+        except Exception:
+            log.exception("Exception receiving message")
+            raise
+        finally:
+            while self._response_futures:
+                self._resolve(
+                    self._response_futures.popleft(),
+                    ConnectionError("Connection to PandA closed"),
+                )
+
+    @staticmethod
+    def _resolve(future, resp):
+        # Requests that timed out in arecv() have had their futures cancelled
+        if future.cancelled():
+            return
+        if isinstance(resp, Exception):
+            future.set_exception(resp)
+        else:
+            future.set_result(resp)
+
+    def _respond(self, resp):
+        """Respond to the future of the oldest outstanding request"""
+        future = self._response_futures.popleft()
+        self._completed_response_lines = []
+        self._is_multiline = None
+        self._resolve(future, resp)
+
+    def _write(self, message, future):
+        # Only ever called in self.loop, so that the order of the futures in
+        # the deque always matches the order of the messages on the wire.
+        self._response_futures.append(future)
+        self._writer.write(message.encode("utf-8"))
+
+    def asend(self, message):
+        """Send a message from within self.loop
+
+        Returns:
+            asyncio.Future: Resolves to the response
+        """
+        future = self.loop.create_future()
+        self._write(message, future)
+        return future
+
+    async def arecv(self, future, timeout=10.0):
+        return await asyncio.wait_for(future, timeout)
+
+    async def asend_recv(self, message, timeout=10.0):
+        return await self.arecv(self.asend(message), timeout)
+
+    def send(self, message):
+        future = concurrent.futures.Future()
+        # Mark as running so the future can no longer be cancelled
+        future.set_running_or_notify_cancel()
+        self.loop.call_soon_threadsafe(self._write, message, future)
+        return future
+
+    def recv(self, response_queue, timeout=10.0):
+        return response_queue.result(timeout)
+
+    async def aget_changes(self, include_errors=False):
+        changes, tables = self._parse_changes(
+            await self.asend_recv("*CHANGES?\n"), include_errors
+        )
+        futures = [(field, self.asend(f"{field}?\n")) for field in tables]
+        for field, future in futures:
+            changes.append((field, await self.arecv(future)))
+        return changes
+
+    async def aset_fields(self, field_values):
+        futures = OrderedDict()
+        for field, value in field_values.items():
+            futures[(field, value)] = self.asend(f"{field}={value}\n")
+        for (field, value), future in futures.items():
+            try:
+                resp = await self.arecv(future)
+            except ValueError as e:
+                raise ValueError(f"Error setting {field} to {value!r}: {e}")
+            else:
+                assert resp == "OK", f"Expected OK, got {resp!r}"
@@ -0,0 +1,733 @@
+# Simulated PandA control server for offline testing and benchmarking.
+# Usage: python3 -m butils.panda_sim [port [hostname]]
+#        PandaDevice(hostname, port, name = ...) as with a real box.
+
+import collections
+import logging
+import math
+import re
+import socketserver
+import sys
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+SIM_FREQ = int(125e6)
+
+simEnums = {
+    "edge": ["Rising", "Falling", "Either"],
+    "disabled": ["Set output low", "Set output high", "Keep current output"],
+    "units": ["min", "s", "ms", "us"],
+    "capture": ["No", "Value", "Diff", "Sum", "Mean",
+        "Min", "Max", "Min Max", "Min Max Mean"],
+    "ext": ["No", "Value"],
+    "term": ["High-Z", "50-Ohm"],
+    "protocol": ["Quadrature", "SSI", "BISS", "enDat"],
+    "state": ["WAIT_ENABLE", "LOAD_TABLE", "WAIT_TRIGGER", "PHASE1", "PHASE2"],
+    "health": ["OK", "Capture events too close together", "Samples overflow"],
+    "trigger": ["Immediate", "BITA=0", "BITA=1", "BITB=0", "BITB=1",
+        "BITC=0", "BITC=1", "POSA>=POSITION", "POSA<=POSITION",
+        "POSB>=POSITION", "POSB<=POSITION", "POSC>=POSITION", "POSC<=POSITION"]
+}
+simUnits = {"min": 60.0, "s": 1.0, "ms": 1e-3, "us": 1e-6}
+
+# (bits, name, type); the order of the output bits is that of `abcdef'.
+simSeqTable = [("15:0", "REPEATS", "uint"), ("19:16", "TRIGGER", "enum"),
+    ("63:32", "POSITION", "int"), ("95:64", "TIME1", "uint")] + \
+    [("%d:%d" % (20 + i, 20 + i), "OUT%s1" % c, "uint")
+        for i, c in enumerate("ABCDEF")] + [("127:96", "TIME2", "uint")] + \
+    [("%d:%d" % (26 + i, 26 + i), "OUT%s2" % c, "uint")
+        for i, c in enumerate("ABCDEF")]
+
+# (block, number, description, [(field, type, subtype, enum)]).
+simBlocks = [
+    ("TTLIN", 6, "TTL input", [
+        ("TERM", "param", "enum", "term"), ("VAL", "bit_out", "", None)
+    ]), ("TTLOUT", 10, "TTL output", [("VAL", "bit_mux", "", None)]),
+    ("INENC", 4, "Input encoder", [
+        ("PROTOCOL", "param", "enum", "protocol"),
+        ("SETP", "write", "int", None), ("RST_ON_Z", "param", "bit", None),
+        ("CONN", "bit_out", "", None)
+    ] + [(f, "bit_out", "", None) for f in ["A", "B", "Z", "DATA"]] +
+        [("VAL", "pos_out", "", None)]),
+    ("OUTENC", 4, "Output encoder", [
+        (f, "bit_mux", "", None) for f in ["ENABLE", "A", "B", "Z", "DATA"]
+    ] + [("PROTOCOL", "param", "enum", "protocol"),
+        ("VAL", "pos_mux", "", None)]),
+    ("LUT", 8, "Lookup table", [("FUNC", "param", "lut", None)] +
+        [("INP%s" % c, "bit_mux", "", None) for c in "ABCDE"] +
+        [("OUT", "bit_out", "", None)]),
+    ("SRGATE", 4, "Set reset gate", [
+        (f, "bit_mux", "", None) for f in ["ENABLE", "SET", "RST"]
+    ] + [
+        ("WHEN_DISABLED", "param", "enum", "disabled"),
+        ("SET_EDGE", "param", "enum", "edge"),
+        ("RST_EDGE", "param", "enum", "edge"),
+        ("FORCE_SET", "write", "action", None),
+        ("FORCE_RST", "write", "action", None), ("OUT", "bit_out", "", None)
+    ]), ("SEQ", 4, "Sequencer", [
+        (f, "bit_mux", "", None) for f in ["ENABLE", "BITA", "BITB", "BITC"]
+    ] + [(f, "pos_mux", "", None) for f in ["POSA", "POSB", "POSC"]] + [
+        ("TABLE", "table", "", None), ("PRESCALE", "param", "time", "units"),
+        ("REPEATS", "param", "uint", None), ("ACTIVE", "bit_out", "", None)
+    ] + [("OUT%s" % c, "bit_out", "", None) for c in "ABCDEF"] + [
+        (f, "read", "uint", None)
+        for f in ["TABLE_REPEAT", "TABLE_LINE", "LINE_REPEAT"]
+    ] + [("STATE", "read", "enum", "state")]),
+    ("PCAP", 1, "Position capture control", [
+        (f, "bit_mux", "", None) for f in ["ENABLE", "GATE", "TRIG"]
+    ] + [
+        ("TRIG_EDGE", "param", "enum", "edge"),
+        ("SHIFT_SUM", "param", "uint", None), ("ACTIVE", "bit_out", "", None)
+    ] + [(f, "ext_out", "timestamp", "ext")
+        for f in ["TS_START", "TS_END", "TS_TRIG"]] +
+        [("GATE_DURATION", "ext_out", "samples", "ext")] +
+        [("BITS%d" % i, "ext_out", "bits", "ext") for i in range(4)] +
+        [("HEALTH", "read", "enum", "health")])
+]
+
+# Sub-attributes reported in `*CHANGES?', and their change groups.
+simAttrs = {
+    "bit_mux": [("DELAY", 0)],
+    "pos_out": [("CAPTURE", "No"), ("UNITS", ""),
+        ("SCALE", 1.0), ("OFFSET", 0.0), ("SCALED", 0.0)],
+    "time": [("UNITS", "s")],
+    "ext_out": [("CAPTURE", "No")]
+}
+simGroups = ["CONFIG", "BITS", "POSN", "READ", "ATTR", "TABLE"]
+simDefaults = {"enum": None, "bit": 0, "int": 0, "uint": 0,
+    "lut": "0", "time": 0.0, "bit_mux": "ZERO", "pos_mux": "ZERO",
+    "bit_out": 0, "pos_out": 0, "table": []}
+
+def sim_fmt(val):
+    return "%.12g" % val if isinstance(val, float) else str(val)
+
+def sim_lut(expr):
+    # Truth table of a LUT function, with `A' as the most significant input.
+    s = expr.replace("!", "~")
+    if not re.fullmatch(r"[A-E01&|^~() ]*", s) or not s.strip():
+        raise ValueError("Invalid LUT function %r" % expr)
+    ret = 0
+    for i in range(32):
+        env = dict((c, (i >> (4 - j)) & 1) for j, c in enumerate("ABCDE"))
+        ret |= (eval(s, {"__builtins__": {}}, env) & 1) << i
+    return ret
+
+def sim_edge(old, new, edge):
+    return old != new and (edge == "Either" or bool(new) == (edge == "Rising"))
+
+class SimEncoder(object):
+    def __init__(self):
+        self.t0, self.p0, self.v, self.t1 = 0.0, 0.0, 0.0, 0.0
+
+    def position(self, t):
+        return self.p0 + self.v * (min(t, self.t1) - self.t0)
+
+    def set(self, t, pos):
+        self.t0, self.p0, self.v, self.t1 = t, pos, 0.0, t
+
+    def move(self, t, target, velocity):
+        pos = self.position(t)
+        self.t0, self.p0 = t, pos
+        self.v = velocity if target > pos else -velocity
+        self.t1 = t + abs(target - pos) / velocity
+
+class SimBlock(object):
+    def __init__(self, sim, name):
+        self.sim, self.name = sim, name
+
+    def val(self, field):
+        return self.sim.values[self.name + "." + field]
+
+    def bit(self, field):
+        return self.sim.bit(self.val(field))
+
+    def pos(self, field):
+        return self.sim.pos(self.val(field))
+
+    def out(self, field, val):
+        self.sim.out(self.name + "." + field, val)
+
+    def update(self):
+        pass
+
+    def action(self, field):
+        pass
+
+    def next_event(self):
+        return None
+
+class SimTtlin(SimBlock):
+    def update(self):
+        self.out("VAL", self.sim.ttlins.get(self.name, 0))
+
+class SimInenc(SimBlock):
+    offset = 0
+
+    def update(self):
+        enc = self.sim.encoders[int(self.name[5:]) - 1]
+        pos = int(round(enc.position(self.sim.now()))) + self.offset
+        quad = pos % 4
+        self.out("CONN", 1)
+        self.out("A", int(quad in (1, 2)))
+        self.out("B", int(quad in (2, 3)))
+        self.out("VAL", pos)
+        self.out("VAL.SCALED",
+            pos * self.val("VAL.SCALE") + self.val("VAL.OFFSET"))
+
+    def action(self, field):
+        assert field == "SETP"
+        self.offset += self.val("SETP") - self.sim.values[self.name + ".VAL"]
+
+class SimLut(SimBlock):
+    def update(self):
+        i = sum(self.bit("INP" + c) << (4 - j) for j, c in enumerate("ABCDE"))
+        self.out("OUT", (self.sim.luts[self.name] >> i) & 1)
+
+class SimSrgate(SimBlock):
+    prev = (0, 0)
+
+    def update(self):
+        s, r = self.bit("SET"), self.bit("RST")
+        prev, self.prev = self.prev, (s, r)
+        if not self.bit("ENABLE"):
+            mode = self.val("WHEN_DISABLED")
+            if mode != "Keep current output":
+                self.out("OUT", int(mode == "Set output high"))
+            return
+        if sim_edge(prev[0], s, self.val("SET_EDGE")):
+            self.out("OUT", 1)
+        if sim_edge(prev[1], r, self.val("RST_EDGE")):
+            self.out("OUT", 0)
+
+    def action(self, field):
+        self.out("OUT", int(field == "FORCE_SET"))
+
+class SimSeq(SimBlock):
+    enable, state, end = 0, "WAIT_ENABLE", None
+    line = line_repeat = table_repeat = 0
+
+    def rows(self):
+        return self.sim.tables[self.name]
+
+    def outs(self, bits):
+        for i, c in enumerate("ABCDEF"):
+            self.out("OUT" + c, (bits >> i) & 1)
+
+    def goto(self, state, end = None):
+        self.state, self.end = state, end
+        self.out("STATE", state)
+        self.out("TABLE_LINE", self.line + 1)
+        self.out("LINE_REPEAT", self.line_repeat)
+        self.out("TABLE_REPEAT", self.table_repeat)
+
+    def stop(self):
+        self.out("ACTIVE", 0)
+        self.outs(0)
+        self.goto("WAIT_ENABLE")
+
+    def triggered(self, trigger, position):
+        if trigger == 0:
+            return True
+        elif trigger <= 6:
+            return self.bit("BIT" + "ABC"[(trigger - 1) // 2]) == trigger % 2 ^ 1
+        pos = self.pos("POS" + "ABC"[(trigger - 7) // 2])
+        return pos >= position if trigger % 2 else pos <= position
+
+    def update(self):
+        en = self.bit("ENABLE")
+        prev, self.enable = self.enable, en
+        if en and not prev and self.rows():
+            self.line, self.line_repeat, self.table_repeat = 0, 1, 1
+            self.out("ACTIVE", 1)
+            self.goto("WAIT_TRIGGER")
+        elif prev and not en and self.state != "WAIT_ENABLE":
+            self.stop()
+        prescale = max(self.sim.raws[self.name + ".PRESCALE"], 1)
+        tick = self.sim.tick
+        while self.state != "WAIT_ENABLE":
+            rows = self.rows()
+            if self.line >= len(rows):
+                self.line = 0
+            repeats, trigger, position, time1, outs1, time2, outs2 = \
+                rows[self.line]
+            if self.state == "WAIT_TRIGGER":
+                if not self.triggered(trigger, position):
+                    break
+                self.outs(outs1)
+                self.goto("PHASE1", tick + max(time1, 1) * prescale)
+            elif tick < self.end:
+                break
+            elif self.state == "PHASE1":
+                self.outs(outs2)
+                self.goto("PHASE2", self.end + max(time2, 1) * prescale)
+            else:
+                self.outs(0)
+                self.line_repeat += 1
+                if repeats and self.line_repeat > repeats:
+                    self.line, self.line_repeat = self.line + 1, 1
+                    if self.line >= len(rows):
+                        self.line, self.table_repeat = 0, self.table_repeat + 1
+                        n = self.val("REPEATS")
+                        if n and self.table_repeat > n:
+                            self.stop()
+                            break
+                self.goto("WAIT_TRIGGER")
+
+    def next_event(self):
+        if self.state in ["PHASE1", "PHASE2"]:
+            return self.end
+        elif self.state == "WAIT_TRIGGER":
+            trigger, position = self.rows()[self.line][1:3]
+            if trigger >= 7:
+                return self.sim.crossing\
+                    (self.val("POS" + "ABC"[(trigger - 7) // 2]), position)
+        return None
+
+class SimPcap(SimBlock):
+    armed, prev = False, (0, 0)
+
+    def update(self):
+        en, trig = self.bit("ENABLE"), self.bit("TRIG")
+        prev, self.prev = self.prev, (en, trig)
+        if self.armed and prev[0] and not en:
+            self.disarm()
+        elif self.armed and en and self.bit("GATE") and \
+            sim_edge(prev[1], trig, self.val("TRIG_EDGE")):
+            self.sim.capture()
+
+    def arm(self):
+        self.armed = True
+        self.out("ACTIVE", 1)
+
+    def disarm(self):
+        self.armed = False
+        self.out("ACTIVE", 0)
+
+simClasses = {"TTLIN": SimTtlin, "INENC": SimInenc, "LUT": SimLut,
+    "SRGATE": SimSrgate, "SEQ": SimSeq, "PCAP": SimPcap}
+
+class PandaSim(object):
+    max_length, step, max_captures = 16384, 1e-3, 1000000
+
+    def __init__(self):
+        self.lock, self.serial, self.changes = threading.RLock(), 0, {}
+        self.values, self.types, self.raws = {}, {}, {}
+        self.tables, self.luts, self.ttlins = {}, {}, {}
+        self.meta, self.blocks, self.fanout = {}, collections.OrderedDict(), None
+        self.work = collections.deque()
+        self.bits, self.poss = ["ZERO", "ONE"], ["ZERO"]
+        for block, n, desc, fields in simBlocks:
+            self.meta[block] = n, desc, fields
+            for i in range(n):
+                name = block + ("%d" % (i + 1) if n > 1 else "")
+                self.blocks[name] = simClasses.get(block, SimBlock)(self, name)
+                for field, typ, sub, enum in fields:
+                    self.add_field(name, field, typ, sub, enum)
+        self.encoders = [SimEncoder() for i in range(4)]
+        self.captures = collections.deque(maxlen = self.max_captures)
+        self.t0, self.tick, self.samples = time.monotonic(), 0, 0
+        self.settle(self.blocks.values())
+
+    def add_field(self, name, field, typ, sub, enum):
+        full = "%s.%s" % (name, field)
+        if typ == "bit_out":
+            self.bits.append(full)
+        elif typ == "pos_out":
+            self.poss.append(full)
+        kind = typ if typ in ["bit_mux", "pos_mux", "bit_out",
+            "pos_out", "table"] else sub
+        self.types[full] = typ, kind, enum
+        if typ == "write" or typ == "ext_out":
+            self.values[full] = ""
+        else:
+            val = simDefaults.get(kind, 0)
+            self.values[full] = simEnums[enum][0] if kind == "enum" else val
+        if kind == "table":
+            self.tables[name] = []
+        elif kind == "lut":
+            self.luts[name] = 0
+        elif kind == "time":
+            self.raws[full] = 0
+        for attr, val in simAttrs.get(typ if typ != "param" else sub, []):
+            self.values[full + "." + attr] = val
+            self.types[full + "." + attr] = "attr", attr, \
+                {"CAPTURE": "capture" if typ == "pos_out" else enum,
+                    "UNITS": enum if typ == "param" else None}.get(attr)
+            self.mark(full + "." + attr)
+        self.mark(full)
+
+    def group(self, name):
+        typ, kind, enum = self.types[name]
+        if typ in ["write", "ext_out"]:
+            return None
+        elif typ == "attr":
+            return "POSN" if kind == "SCALED" else "ATTR"
+        return {"bit_out": "BITS", "pos_out": "POSN",
+            "read": "READ", "table": "TABLE"}.get(typ, "CONFIG")
+
+    def mark(self, name):
+        self.serial += 1
+        self.changes[name] = self.serial
+
+    def now(self):
+        return self.tick / SIM_FREQ
+
+    def bit(self, label):
+        return self.values[label] if label not in ["ZERO", "ONE"] \
+            else int(label == "ONE")
+
+    def pos(self, label):
+        return 0 if label == "ZERO" else self.values[label]
+
+    def out(self, name, val):
+        if self.values[name] != val:
+            self.values[name] = val
+            self.mark(name)
+            if self.fanout is None:
+                self.make_fanout()
+            self.work.extend(self.fanout.get(name, []))
+
+    def make_fanout(self):
+        self.fanout = collections.defaultdict(list)
+        for full, (typ, kind, enum) in self.types.items():
+            if typ in ["bit_mux", "pos_mux"]:
+                self.fanout[self.values[full]].append\
+                    (self.blocks[full.split(".")[0]])
+
+    def settle(self, blocks):
+        self.work.extend(blocks)
+        for i in range(100000):
+            if not self.work:
+                return
+            self.work.popleft().update()
+        raise RuntimeError("PandA simulation failed to settle")
+
+    def advance(self, tick = None):
+        if tick is None:
+            tick = int((time.monotonic() - self.t0) * SIM_FREQ)
+        seqs = [b for b in self.blocks.values() if isinstance(b, SimSeq)]
+        while True:
+            events = [e for e in (b.next_event() for b in seqs)
+                if e is not None and e <= tick]
+            self.tick = max(self.tick, min(events) if events else tick)
+            self.settle([b for b in self.blocks.values() if isinstance
+                (b, (SimInenc, SimTtlin))] + (seqs if events else []))
+            if not events:
+                return
+
+    # Exact time when an encoder position reaches `target', so that position
+    # compare is not limited to the granularity of `step'.
+    def crossing(self, label, target):
+        m = re.fullmatch(r"INENC([1-4])\.VAL", label)
+        if not m:
+            return None
+        enc = self.encoders[int(m.group(1)) - 1]
+        if not enc.v:
+            return None
+        t = enc.t0 + (target - self.blocks["INENC" + m.group(1)].offset
+            - enc.p0) / enc.v
+        tick = int(math.ceil(t * SIM_FREQ))
+        return tick if t <= enc.t1 and tick > self.tick else None
+
+    def capture(self):
+        self.samples += 1
+        data = {"TS_TRIG": self.now()}
+        for name in self.poss[1:]:
+            cap = self.values[name + ".CAPTURE"]
+            if cap != "No":
+                val = self.values[name + ".SCALED"]
+                data.update(("%s.%s" % (name, c), val) for c in cap.split())
+        self.captures.append(data)
+
+    def set_position(self, n, counts):
+        with self.lock:
+            self.advance()
+            self.encoders[n - 1].set(self.now(), counts)
+
+    def move(self, n, target, velocity):
+        with self.lock:
+            self.advance()
+            self.encoders[n - 1].move(self.now(), target, velocity)
+
+    def follow(self, n, signal, scale = 1.0, offset = 0.0):
+        return signal.subscribe(lambda *, value, **kwargs: value is None or
+            self.set_position(n, (value - offset) / scale))
+
+    def set_ttlin(self, n, val):
+        with self.lock:
+            self.advance()
+            self.ttlins["TTLIN%d" % n] = int(bool(val))
+            self.settle([self.blocks["TTLIN%d" % n]])
+
+    def parse(self, name, s):
+        typ, kind, enum = self.types[name]
+        if typ in ["bit_mux", "pos_mux"]:
+            labels = self.bits if typ == "bit_mux" else self.poss
+        else:
+            labels = simEnums[enum] if enum and \
+                kind in ["enum", "CAPTURE", "UNITS"] else None
+        if labels:
+            if s not in labels:
+                raise ValueError("Invalid enumeration value")
+            return s
+        elif kind in ["bit", "int", "uint", "DELAY"]:
+            val = int(s)
+            if (kind == "bit" and val not in [0, 1]) or \
+                (kind == "uint" and val < 0):
+                raise ValueError("Number out of range")
+            return val
+        elif kind in ["time", "SCALE", "OFFSET"]:
+            return float(s)
+        elif kind == "action" and s:
+            raise ValueError("Action takes no value")
+        return s
+
+    def set_field(self, name, s):
+        if name.endswith(".RAW") and name[:-4] in self.raws:
+            name = name[:-4]
+            s = "%.12g" % (int(s) / SIM_FREQ /
+                simUnits[self.values[name + ".UNITS"]])
+        if name not in self.types or self.types[name][0] in \
+            ["bit_out", "pos_out", "read", "table", "ext_out"] or \
+            self.types[name][1] == "SCALED":
+            raise ValueError("No such writeable field")
+        val = self.parse(name, s)
+        typ, kind, enum = self.types[name]
+        block, field = name.split(".", 1)
+        if kind == "lut":
+            self.luts[block] = sim_lut(val)
+        elif kind == "time":
+            self.raws[name] = int(round(val * simUnits[self.values
+                [name + ".UNITS"]] * SIM_FREQ))
+        elif typ == "attr" and kind == "UNITS" and enum:
+            val0 = self.raws[name[:-6]] / simUnits[val] / SIM_FREQ
+            self.values[name[:-6]] = val0
+        self.values[name] = val
+        if typ != "write":
+            self.mark(name)
+        if typ in ["bit_mux", "pos_mux"]:
+            self.fanout = None
+        if typ == "write":
+            self.blocks[block].action(field)
+        self.settle([self.blocks[block]])
+
+    def set_table(self, name, words):
+        block = name.split(".")[0]
+        if self.types.get(name, (None,))[0] != "table":
+            raise ValueError("No such table")
+        if len(words) % 4 or len(words) > self.max_length:
+            raise ValueError("Invalid table length")
+        rows = []
+        for i in range(0, len(words), 4):
+            w0, w1, w2, w3 = words[i : i + 4]
+            rows.append((w0 & 0xffff, (w0 >> 16) & 0xf,
+                w1 - (1 << 32) if w1 >= 1 << 31 else w1,
+                w2, (w0 >> 20) & 0x3f, w3, (w0 >> 26) & 0x3f))
+        self.tables[block], self.values[name] = rows, list(words)
+        self.mark(name)
+        self.settle([self.blocks[block]])
+
+    def get_attr(self, name):
+        if name in self.values and self.types[name][0] not in \
+            ["write", "ext_out", "table"]:
+            return sim_fmt(self.values[name])
+        name, attr = name.rsplit(".", 1)
+        if name not in self.types:
+            raise ValueError("No such field")
+        typ, kind, enum = self.types[name]
+        if attr == "MAX_LENGTH" and typ == "table":
+            return str(self.max_length)
+        elif attr == "LENGTH" and typ == "table":
+            return str(len(self.values[name]))
+        elif attr == "MAX" and kind == "uint":
+            return str(2 ** 32 - 1)
+        elif attr == "MAX_DELAY" and typ == "bit_mux":
+            return "31"
+        elif attr == "RAW" and kind == "lut":
+            return "0x%08X" % self.luts[name.split(".")[0]]
+        elif attr == "RAW" and kind == "time":
+            return str(self.raws[name])
+        elif attr == "MIN" and kind == "time":
+            return sim_fmt(1.0 / SIM_FREQ)
+        elif attr in ["CAPTURE_WORD", "OFFSET"] and typ == "bit_out":
+            i = self.bits.index(name) - 2
+            return "PCAP.BITS%d" % (i // 32) if attr == "CAPTURE_WORD" \
+                else str(i % 32)
+        raise ValueError("No such attribute")
+
+    def field_meta(self, block, field = None):
+        block = re.sub(r"[0-9]+$", "", block)
+        if block not in self.meta:
+            raise ValueError("No such block")
+        fields = self.meta[block][2]
+        if field is None:
+            return self.meta[block]
+        for f in fields:
+            if f[0] == field:
+                return f
+        raise ValueError("No such field")
+
+    def get_multi(self, req):
+        m = re.fullmatch(r"\*ENUMS\.([^.]+)\.TABLE\[\]\.([^.]+)", req)
+        if m:
+            if m.group(2) != "TRIGGER":
+                raise ValueError("Table field has no enumeration")
+            return simEnums["trigger"]
+        m = re.fullmatch(r"\*ENUMS\.([^.]+)\.([^.]+)(\.[A-Z]+)?", req)
+        if m:
+            block, field, attr = m.groups()
+            f, typ, sub, enum = self.field_meta(block, field)
+            if typ in ["bit_mux", "pos_mux"] and not attr:
+                return self.bits if typ == "bit_mux" else self.poss
+            elif typ == "pos_out" and attr == ".CAPTURE":
+                return simEnums["capture"]
+            elif enum and (attr, typ, sub) in [(".CAPTURE", "ext_out", sub),
+                (".UNITS", typ, "time"), (None, typ, "enum")]:
+                return simEnums[enum]
+            raise ValueError("Field has no enumeration")
+        if req == "*BLOCKS":
+            return ["%s %d" % (b, n) for b, (n, desc, fields)
+                in self.meta.items()]
+        if req.startswith("*CHANGES"):
+            return None
+        if req == "*CAPTURE":
+            return [name + "." + self.values[name + ".CAPTURE"]
+                for name in self.poss[1:]
+                if self.values[name + ".CAPTURE"] != "No"]
+        m = re.fullmatch(r"([^.*]+)\.\*", req)
+        if m:
+            return ["%s %d %s%s" % (f, i, typ, " " + sub if sub else "")
+                for i, (f, typ, sub, enum) in
+                enumerate(self.field_meta(m.group(1))[2])]
+        m = re.fullmatch(r"([^.]+)\.TABLE\.FIELDS", req)
+        if m:
+            self.field_meta(m.group(1), "TABLE")
+            return ["%s %s %s" % f for f in simSeqTable]
+        m = re.fullmatch(r"PCAP\.BITS([0-3])\.BITS", req)
+        if m:
+            bits = self.bits[2:] + [""] * 128
+            i = int(m.group(1))
+            return bits[32 * i : 32 * (i + 1)]
+        if req in self.types and self.types[req][0] == "table":
+            return [str(w) for w in self.values[req]]
+        return None
+
+    def get_desc(self, req):
+        parts = req[len("*DESC."):].split(".")
+        if len(parts) == 1:
+            return self.field_meta(parts[0])[1]
+        if parts[1] == "TABLE[]":
+            return dict((f, "Sequencer table %s" % f.lower())
+                for b, f, t in simSeqTable)[parts[2]]
+        f, typ, sub, enum = self.field_meta(parts[0], parts[1])
+        return "%s %s" % (f.replace("_", " ").capitalize(), typ)
+
+    def get_changes(self, conn, group):
+        groups = simGroups if group is None else [group]
+        ret, last = [], dict((g, conn.get(g, 0)) for g in groups)
+        for name, serial in self.changes.items():
+            g = self.group(name)
+            if g in last and serial > last[g]:
+                ret.append(name + "<" if g == "TABLE"
+                    else "%s=%s" % (name, sim_fmt(self.values[name])))
+        for g in groups:
+            conn[g] = self.serial
+        return ret
+
+    def request(self, conn, req, table = None):
+        with self.lock:
+            self.advance()
+            if table is not None:
+                self.set_table(req[:-1], [int(s) for s in table])
+                return "OK"
+            if req in ["*PCAP.ARM=", "*PCAP.DISARM="]:
+                pcap = self.blocks["PCAP"]
+                pcap.arm() if req == "*PCAP.ARM=" else pcap.disarm()
+                self.settle([pcap])
+                return "OK"
+            if req == "*CAPTURE=":
+                for name in self.poss[1:]:
+                    self.set_field(name + ".CAPTURE", "No")
+                for f, typ, sub, enum in self.meta["PCAP"][2]:
+                    if typ == "ext_out":
+                        self.values["PCAP.%s.CAPTURE" % f] = "No"
+                        self.mark("PCAP.%s.CAPTURE" % f)
+                return "OK"
+            if "=" in req:
+                name, val = req.split("=", 1)
+                self.set_field(name, val)
+                return "OK"
+            if not req.endswith("?"):
+                raise ValueError("Unknown command")
+            req = req[:-1]
+            m = re.fullmatch(r"\*CHANGES(\.([A-Z]+))?", req)
+            if m:
+                if m.group(2) and m.group(2) not in simGroups:
+                    raise ValueError("Unknown changes group")
+                return self.get_changes(conn, m.group(2))
+            if req.startswith("*DESC."):
+                return "OK =" + self.get_desc(req)
+            if req == "*IDN":
+                return "OK =PandA SW: sim FPGA: sim"
+            ret = self.get_multi(req)
+            if ret is not None:
+                return ret
+            return "OK =" + self.get_attr(req)
+
+    def run(self):
+        while True:
+            with self.lock:
+                self.advance()
+            time.sleep(self.step)
+
+class PandaSimHandler(socketserver.StreamRequestHandler):
+    disable_nagle_algorithm = True
+
+    def handle(self):
+        conn, sim = {}, self.server.sim
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            line, table = line.decode("utf-8").rstrip("\n"), None
+            if line.endswith("<"):
+                table = []
+                while True:
+                    row = self.rfile.readline().decode("utf-8").strip()
+                    if not row:
+                        break
+                    table.append(row)
+            try:
+                resp = sim.request(conn, line, table)
+            except (ValueError, KeyError, IndexError) as e:
+                resp = "ERR %s" % (e.args[0] if e.args else type(e).__name__)
+            if isinstance(resp, list):
+                resp = "".join("!%s\n" % s for s in resp) + ".\n"
+            else:
+                resp += "\n"
+            self.wfile.write(resp.encode("utf-8"))
+
+class PandaSimServer(socketserver.ThreadingTCPServer):
+    daemon_threads, allow_reuse_address = True, True
+
+    def __init__(self, hostname = "localhost", port = 8888, sim = None):
+        self.sim = sim or PandaSim()
+        super().__init__((hostname, port), PandaSimHandler)
+
+    def start(self):
+        threading.Thread(target = self.sim.run, daemon = True).start()
+        threading.Thread(target = self.serve_forever, daemon = True).start()
+        return self.server_address
+
+def main():
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8888
+    hostname = sys.argv[2] if len(sys.argv) > 2 else "localhost"
+    server = PandaSimServer(hostname, port)
+    threading.Thread(target = server.sim.run, daemon = True).start()
+    print("Simulated PandA listening on %s:%d" % server.server_address)
+    server.serve_forever()
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,9 @@
 import collections
 import re
+from ophyd import Signal
 from ophyd.ophydobj import OphydObject
 from bluesky import plan_stubs as bps, preprocessors as bpp
+from bluesky.utils import Msg, single_gen
 
 _cfg_trans = [lambda dev, cfg: cfg]
 
@@ -34,6 +36,68 @@ def ctrans_reg(ctrans = ctrans_base):
         bps.configure = lambda dev, cfg, **kwargs: \
             bps._configure(dev, cfg_trans(dev, cfg), **kwargs)
 
+def cfg_same(x, y):
+    try:
+        return x is y or bool(x == y)
+    except (TypeError, ValueError):
+        return False
+
+# Elides configures of values already applied to the same device within the
+# run; actions (eg. `cam.acquire') are never elided, but their values are
+# remembered.  Staging forgets about the device, as stage_sigs are involved.
+# The counts are read into the "configures" stream right before close_run,
+# and so appear in `num_events' of the stop document.
+class ConfigureDiff(object):
+    def __init__(self):
+        self.applied, self.counts, self.passed = {}, None, None
+        self.signals = dict((k, Signal(name = "configures_" + k, value = 0))
+            for k in ["issued", "skipped"])
+
+    def report(self, msg):
+        for k, sig in self.signals.items():
+            sig.put(self.counts[k])
+        self.counts = None
+        yield from bps.trigger_and_read\
+            (list(self.signals.values()), name = "configures")
+        return (yield msg)
+
+    def mutate(self, msg):
+        if msg is self.passed:
+            self.passed = None
+            return None, None
+        if msg.command in ["open_run", "close_run"]:
+            self.applied.clear()
+            if msg.command == "open_run":
+                self.counts = {"issued": 0, "skipped": 0}
+            elif self.counts is not None:
+                return self.report(msg), None
+        elif msg.command in ["stage", "unstage"]:
+            self.applied.pop(msg.obj, None)
+        if msg.command != "configure" or self.counts is None:
+            return None, None
+        cfg, action = msg.args[0], msg.kwargs.get("action")
+        applied = self.applied.setdefault(msg.obj, {})
+        if not action:
+            cfg = collections.OrderedDict((k, v) for k, v in cfg.items()
+                if not (k in applied and cfg_same(applied[k], v)))
+        for k, v in cfg.items():
+            if not action or isinstance(v, (int, float, str)):
+                applied[k] = v
+            else:
+                applied.pop(k, None)
+        if not cfg:
+            self.counts["skipped"] += 1
+            return single_gen(Msg("null")), None
+        self.counts["issued"] += 1
+        if len(cfg) == len(msg.args[0]):
+            return None, None
+        # plan_mutator() passes the replacement through mutate() again.
+        self.passed = msg._replace(args = (cfg,) + msg.args[1:])
+        return single_gen(self.passed), None
+
+def cfg_diff_wrapper(plan):
+    return bpp.plan_mutator(plan, ConfigureDiff().mutate)
+
 def motors_get(args, use_list = False):
     return list(args[::2] if use_list else args[::4])
 
@@ -9,9 +9,9 @@ from ophyd import Component, Signal, ADComponent, \
 from ophyd.signal import AttributeSignal
 from ophyd.sim import SynSignal
 from .ad import CptHDF5
-from .ophyd import ThrottleMonitor
+from .ophyd import ImageMonitor
 
-class SimImage(ThrottleMonitor):
+class SimImage(ImageMonitor):
     image, func = Component(SynSignal), None
 
     def __init__(self, *, name, func = None, **kwargs):
@@ -28,10 +28,9 @@ class SimImage(ThrottleMonitor):
         _timestamp = [0.0]
         def cb(*, value, timestamp, **kwargs):
             if value is not None and self.maybe_monitor(_timestamp, timestamp):
-                dnotify("monitor/" + typ, {
-                    "data": {self.image.name: value},
-                    "timestamps": {self.image.name: timestamp}
-                })
+                data = self.reduce_image(self.image.name, value)
+                dnotify("monitor/" + typ, {"data": data,
+                    "timestamps": dict((k, timestamp) for k in data)})
         return self.image.subscribe(cb)
 
 class SimMotorImage(SimImage):
@@ -60,10 +59,9 @@ class SimMotorImage(SimImage):
     def monitor(self, dnotify, typ = "image"):
         def cb(*, value, timestamp, **kwargs):
             if value is not None:
-                dnotify("monitor/" + typ, {
-                    "data": {self.image.name: value},
-                    "timestamps": {self.image.name: timestamp}
-                })
+                data = self.reduce_image(self.image.name, value)
+                dnotify("monitor/" + typ, {"data": data,
+                    "timestamps": dict((k, timestamp) for k in data)})
         return self.image.subscribe(cb)
 
 class SimCounterImage(SimImage):
@@ -0,0 +1,163 @@
+import collections
+import math
+
+# Default durations (in seconds) of messages that do not move anything.
+SIM_LATENCY = {
+    "configure": 0.01, "arm": 0.1, "set": 0.005, "trigger": 0.01,
+    "read": 0.002, "stage": 0.05, "unstage": 0.05
+}
+
+def trapezoid(d, velocity, acceleration):
+    # Time to reach `velocity' is `acceleration', as with the motor record.
+    if d <= 0.0:
+        return 0.0, lambda t: 0.0
+    a = velocity / acceleration if acceleration > 0.0 else math.inf
+    tacc = min(acceleration, math.sqrt(d / a)) if a < math.inf else 0.0
+    vp = a * tacc if tacc else velocity
+    total = d / vp + tacc
+    def pos(t):
+        if t >= total:
+            return d
+        elif t < tacc:
+            return a * t * t / 2
+        elif t > total - tacc:
+            return d - a * (total - t) ** 2 / 2
+        return a * tacc * tacc / 2 + vp * (t - tacc)
+    return total, pos
+
+class SimMotor(object):
+    def __init__(self, motor, position = None,
+        velocity = None, acceleration = None, backlash = None):
+        self.motor = motor
+        get = lambda x, attr: getattr(motor, attr).get() if x is None else x
+        self.velocity = get(velocity, "velocity")
+        self.acceleration = get(acceleration, "acceleration")
+        self.backlash = backlash if backlash is not None else \
+            motor.motor_bdst.get() if hasattr(motor, "motor_bdst") else 0.0
+        self.p0 = self.target = motor.position if position is None else position
+        self.t0, self.t1, self.pos = 0.0, 0.0, lambda t: 0.0
+
+    def position(self, t):
+        if t >= self.t1:
+            return self.target
+        sign = 1 if self.target >= self.p0 else -1
+        return self.p0 + sign * self.pos(t - self.t0)
+
+    def move(self, t, target):
+        # Moves against the backlash direction overshoot and come back.
+        self.p0, self.target, self.t0 = self.position(t), target, t
+        d, b = abs(target - self.p0), abs(self.backlash)
+        if b and (target - self.p0) * self.backlash < 0:
+            self.t1, self.pos = trapezoid(d + b, self.velocity, self.acceleration)
+            self.t1 += trapezoid(b, self.velocity, self.acceleration)[0]
+        else:
+            self.t1, self.pos = trapezoid(d, self.velocity, self.acceleration)
+        self.t1 += t
+        return self.t1
+
+class Timeline(object):
+    def __init__(self, motors = {}, latencies = {}):
+        self.overrides, self.latencies = motors, dict(SIM_LATENCY)
+        self.latencies.update((k, v) for k, v in latencies.items()
+            if isinstance(k, str))
+        self.dev_latencies = dict((k, dict(v)) for k, v in latencies.items()
+            if not isinstance(k, str))
+        self.t, self.motors, self.groups = 0.0, {}, collections.defaultdict(list)
+        self.phases = []
+
+    def motor(self, obj):
+        if obj not in self.motors:
+            if obj not in self.overrides and not \
+                (hasattr(obj, "velocity") and hasattr(obj, "acceleration")):
+                return None
+            self.motors[obj] = SimMotor(obj, **self.overrides.get(obj, {}))
+        return self.motors[obj]
+
+    def latency(self, kind, obj = None):
+        lats = self.dev_latencies.setdefault(obj, {})
+        if kind == "trigger" and kind not in lats and \
+            hasattr(getattr(obj, "cam", None), "acquire_time"):
+            lats[kind] = self.latencies[kind] + obj.cam.acquire_time.get()
+        return lats.get(kind, self.latencies.get(kind, 0.0))
+
+    def phase(self, kind, obj, dt):
+        name = getattr(obj, "name", None) or ""
+        if self.phases and self.phases[-1][2:] == (kind, name) \
+            and self.phases[-1][1] == self.t:
+            self.phases[-1] = (self.phases[-1][0], self.t + dt, kind, name)
+        else:
+            self.phases.append((self.t, self.t + dt, kind, name))
+        self.t += dt
+
+    def done(self, msg, t):
+        group = msg.kwargs.get("group")
+        if group is not None:
+            self.groups[group].append((t, msg.obj))
+
+    def handle(self, msg):
+        cmd, obj = msg.command, msg.obj
+        if cmd == "set":
+            motor = self.motor(obj)
+            self.phase("set", obj, self.latency("set", obj))
+            self.done(msg, self.t if motor is None
+                else motor.move(self.t, msg.args[0]))
+        elif cmd == "wait":
+            group = msg.kwargs.get("group", msg.args[0] if msg.args else None)
+            for t, obj in self.groups.pop(group, []):
+                if t > self.t:
+                    self.phase("move" if obj in self.motors
+                        else "trigger", obj, t - self.t)
+        elif cmd == "trigger":
+            self.done(msg, self.t + self.latency("trigger", obj))
+            if msg.kwargs.get("group") is None:
+                self.phase("trigger", obj, self.latency("trigger", obj))
+        elif cmd == "configure":
+            cfg = msg.args[0] if msg.args else {}
+            kind = "arm" if "cam.acquire" in cfg else "configure"
+            motor = self.motor(obj)
+            if motor is not None and "velocity" in cfg:
+                motor.velocity = cfg["velocity"]
+            self.phase(kind, obj, self.latency(kind, obj))
+        elif cmd in ["read", "locate"]:
+            self.phase("read", obj, self.latency("read", obj))
+            motor = self.motor(obj)
+            if motor is None:
+                return {}
+            pos = motor.position(self.t)
+            return {"readback": pos, "setpoint": motor.target} \
+                if cmd == "locate" else \
+                {obj.name: {"value": pos, "timestamp": self.t}}
+        elif cmd in ["stage", "unstage"]:
+            self.phase(cmd, obj, self.latency(cmd, obj))
+            return [obj]
+        elif cmd == "sleep":
+            self.phase("sleep", None, msg.args[0])
+        elif cmd == "open_run":
+            return "simulated"
+        return None
+
+    def totals(self):
+        ret = collections.OrderedDict()
+        for t0, t1, kind, name in self.phases:
+            ret[kind] = ret.get(kind, 0.0) + t1 - t0
+        return ret
+
+    def report(self, verbose = False):
+        if verbose:
+            for t0, t1, kind, name in self.phases:
+                print("%10.3f %10.3f  %-9s %s" % (t0, t1, kind, name))
+        for kind, t in self.totals().items():
+            print("%-9s %10.3f s" % (kind, t))
+        print("%-9s %10.3f s" % ("total", self.t))
+
+# Runs `plan' against a virtual clock, without touching any hardware except
+# for reading parameters not given in `motors' ({motor: {"velocity": ...}})
+# and `latencies' ({"arm": ...} or {device: {"trigger": ...}}).
+def simulate(plan, motors = {}, latencies = {}):
+    tl, ret = Timeline(motors, latencies), None
+    while True:
+        try:
+            msg = plan.send(ret)
+        except StopIteration:
+            return tl
+        ret = tl.handle(msg)
@@ -0,0 +1,46 @@
+# Usage: PYTHONPATH=. python3 docs/bench_panda.py [rows]
+# Times sequencer table packing, unpacking and uploading against butils.panda_sim.
+
+import sys
+import time
+import numpy
+from butils.panda import panda_table_fmt_alt, panda_table_unfmt
+from butils.panda_client import PandABlocksClient
+from butils.panda_sim import PandaSimServer
+
+def timed(desc, f, *args):
+    t = time.monotonic()
+    ret = f(*args)
+    print("%-32s %8.3f s" % (desc, time.monotonic() - t))
+    return ret
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    server = PandaSimServer("localhost", 0)
+    server.sim.max_length = 4 * n
+    client = PandABlocksClient(*server.start())
+    client.start()
+    fields = client.get_table_fields("SEQ1", "TABLE")
+
+    table = dict((f.lower(), numpy.zeros(n, dtype = "int64")) for f in fields)
+    table["trigger"] = numpy.array(["POSA>=POSITION", "POSA<=POSITION"])\
+        .take(numpy.arange(n) % 2)
+    table["position"] = (numpy.arange(n) - n // 2) * 20
+    table["time1"][:], table["time2"][:] = 125, 1
+    table["repeats"][:], table["outa1"][:] = 1, 1
+    lists = dict((k, v.tolist()) for k, v in table.items())
+    struct = numpy.rec.fromarrays([table[f.lower()] for f in fields],
+        names = [f.lower() for f in fields])
+
+    print("%d rows" % n)
+    raw = timed("fmt (dict of arrays)", panda_table_fmt_alt, fields, table)
+    timed("fmt (dict of lists)", panda_table_fmt_alt, fields, lists)
+    timed("fmt (structured array)", panda_table_fmt_alt, fields, struct)
+    cols = timed("unfmt", panda_table_unfmt, fields.values(), raw)
+    assert all(numpy.array_equal(numpy.asarray(table[f.lower()],
+        dtype = c.dtype), c) for f, c in zip(fields, cols))
+    timed("upload", client.set_table, "SEQ1", "TABLE", raw)
+    client.stop()
+
+if __name__ == "__main__":
+    main()
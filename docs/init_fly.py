@@ -6,9 +6,9 @@ print("Example beamline init script loading...")
 import os
 from bluesky import RunEngine
 from ophyd.device import STAGE_KEEP
-from butils.ad import BaseAreaDetector
+from butils.ad import BaseAreaDetector, warmup_all
 from butils.bubo import BuboDevice
-from butils.common import AttrDict, fn_wait
+from butils.common import AttrDict
 from butils.fly import prep_dseq, seq_dwarmup
 from butils.ophyd import MyEpicsMotor
 from butils.panda import PandaDevice
@@ -42,7 +42,7 @@ D.xsp3.hdf1.write_path_template = os.getcwd() + "/big"
 D.xsp3.stage_sigs.update\
     ({"cam.trigger_mode": STAGE_KEEP, "cam.num_images": STAGE_KEEP})
 D.xsp3.cam.configure({"trigger_mode": 1, "num_images": 1, "acquire_time": 0.1})
-assert fn_wait([D[det].warmup for det in ["adp", "xsp3"]])
+warmup_all([D.adp, D.xsp3])
 
 D.panda.configure({"dseq.enable": 0, "pcap.enable": "ZERO"})
 D.adp.cam.image_mode.set(2).wait()
@@ -1,6 +1,7 @@
 import base64
 import pickle
 import time
+from butils.data import frames_resolve
 from .zserver import ZError, raise_syntax, unary_op, znc_handle_gen
 
 def mzs_dev(self, req):
@@ -46,7 +47,34 @@ def mzs_scan(self, req):
         raise_syntax(req)
     return {"err": ""}
 
-addonMzs = {"dev": mzs_dev, "scan": mzs_scan}
+def frame_policy_check(policy):
+    return policy in ["full", "drop"] or \
+        (isinstance(policy, int) and not isinstance(policy, bool) and policy > 0)
+
+# Policies are keyed by field, with `None' (`null' in JSON) for the default.
+def mzs_frames(self, req):
+    op = unary_op(req)
+    policies = self.state.frame_policies
+    if op == "get":
+        return {"err": "", "ret": list(policies.items())}
+    elif op == "set":
+        try:
+            field, policy = req.get("field"), req.get("policy")
+            assert field is None or isinstance(field, str)
+            assert policy is None or frame_policy_check(policy)
+        except:
+            raise_syntax(req)
+        if policy is None:
+            policies.pop(field, None)
+        else:
+            policies[field] = policy
+    elif op == "clear":
+        policies.clear()
+    else:
+        raise_syntax(req)
+    return {"err": ""}
+
+addonMzs = {"dev": mzs_dev, "frames": mzs_frames, "scan": mzs_scan}
 
 def doc_handle_gen(typ):
     def handler(self, msg):
@@ -60,9 +88,11 @@ addonMnc = {
     "scan": znc_handle_gen("scan")
 }
 
-def doc_notify(notify):
-    return lambda typ, doc: notify({"typ": typ, "doc":
-        base64.b64encode(pickle.dumps(doc)).decode("UTF-8")})
+# Lazily filled frames are handled according to `policies';
+# cf. butils.data.frames_resolve().
+def doc_notify(notify, policies = {}):
+    return lambda typ, doc: notify({"typ": typ, "doc": base64.b64encode\
+        (pickle.dumps(frames_resolve(doc, policies))).decode("UTF-8")})
 
 def lossy_notify(periods, dnotify):
     timestamps, caches = {}, {}
@@ -91,7 +121,11 @@ def mzserver_callback(notify, dnotify):
     return cb
 
 def state_build(U, config):
-    U.dnotify, U.monitor_periods = doc_notify(U.mzs.notify), {}
+    U.monitor_periods, U.frame_policies = {}, {}
+    for k, v in config["backend"].get("frame_policies", {}).items():
+        assert frame_policy_check(v), "invalid frame policy: %r" % v
+        U.frame_policies[k] = v
+    U.dnotify = doc_notify(U.mzs.notify, U.frame_policies)
     U.lnotify = lossy_notify(U.monitor_periods, U.dnotify)
     U.mzcb = mzserver_callback(U.mzs.notify, U.dnotify)
 
@@ -1,11 +1,17 @@
+import h5py
+import math
 import os
+import queue
+import threading
+import time
 from epics import caget
 from bluesky import plans
 from bluesky.callbacks.core import CallbackBase
 from butils.data import ImageFiller, my_broker
-from butils.fly import fly_dsimple, \
-    fly_pcomp, fly_simple, sfly_simple, velo_simple
-from butils.plans import motors_get, plan_fmt
+from butils.fly import fly_cgrid, fly_dsimple, fly_gtime, fly_hpcomp, \
+    fly_list_pcomp, fly_pcomp, fly_simple, fly_tcount, sfly_simple, velo_simple
+from butils.plans import motors_get, norm_snake, plan_fmt
+from butils.timeline import simulate
 from .progress import ProgressReporter, progressBars
 
 class BasePlanner(object):
@@ -28,6 +34,12 @@ class BasePlanner(object):
             "plan_cmd": plan_fmt(("P." + plan, args, kwargs))
         }), cb, md = md)
 
+    def simulate(self, plan, *args, timeline = {}, verbose = False, **kwargs):
+        kwargs.pop("md", None)
+        ret = simulate(self.plans[plan](*args, **kwargs), **timeline)
+        ret.report(verbose)
+        return ret
+
 class ChildPlanner(BasePlanner):
     parent = None
 
@@ -44,9 +56,10 @@ class ParentPlanner(BasePlanner):
         ret = type("MambaPlans", (object,), {})()
         for obj in self.origins:
             for plan in obj.plans:
-                setattr(ret, plan, (lambda run, plan:
-                    lambda *args, **kwargs: run(plan, *args, **kwargs)
-                )(obj.run, plan))
+                f = (lambda run, plan: lambda *args, **kwargs:
+                    run(plan, *args, **kwargs))
+                setattr(ret, plan, f(obj.run, plan))
+                getattr(ret, plan).simulate = f(obj.simulate, plan)
         return ret
 
 class MambaPlanner(ParentPlanner):
@@ -78,7 +91,7 @@ class MambaPlanner(ParentPlanner):
 class ImagePlanner(MambaPlanner):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.filler = ImageFiller()
+        self.filler = ImageFiller(lazy = True)
 
     def callback(self, plan, *args, **kwargs):
         return [self.filler, self.U.mzcb, self.progress]
@@ -108,6 +121,56 @@ def div_get(divs, dets, num):
     assert div >= num or not div
     return div // num
 
+# Rough costs of arming a fragment and of uploading a sequencer table row.
+FRAG_OVERHEAD, ROW_TIME = 0.5, 2e-6
+
+def velo_get(args, kwargs):
+    motor, lo, hi, num = args[-4:]
+    return velo_simple(motor, lo, hi, num, kwargs["duty"],
+        **{k: kwargs.get(k) for k in ["period", "atime", "velocity", "pad"]})
+
+def line_time(args, kwargs):
+    motor, lo, hi, num = args[-4:]
+    period, velos, pad = velo_get(args, kwargs)
+    acc = 2 * motor.acceleration.get()
+    dist = abs(hi - lo) * (1 + kwargs["duty"] / (num - 1)) + 2 * pad
+    ret, back = dist / velos[1] + acc, dist / velos[0] + acc
+    if motor in norm_snake(kwargs.get("snake_axes", True), motors_get(args)):
+        back = 0.0
+    if len(args) > 4:
+        omotor, olo, ohi, onum = args[-8:-4]
+        back = max(back, abs(ohi - olo) / max(onum - 1, 1) /
+            omotor.velocity.get() + 2 * omotor.acceleration.get())
+    return ret + back, period * kwargs["duty"] * num
+
+# Lines per fragment, within the buffer depths in `divs' (combined like
+# div_get()): the size with the shortest predicted scan, preferring sizes
+# that fill whole HDF5 chunks.  Each fragment costs `overhead' plus the
+# upload of its first (up to `max_rows') sequencer rows, and each line the
+# time from line_time(), including acceleration and turnaround.  Returns
+# the size and the predicted timeline, as
+# {"fragments": [[lines, start, end], ...], "total": ..., "dead": ...}.
+def div_auto(divs, dets, args, kwargs,
+    max_rows = 0, overhead = FRAG_OVERHEAD):
+    num, lines = args[-1], math.prod(args[3:-4:4])
+    dmax = min(lines, div_get(divs, dets, num) or lines)
+    chunks = [det.hdf1.num_frames_chunks.get() for det in dets
+        if det in divs and hasattr(det, "hdf1")]
+    tline, live = line_time(args, kwargs)
+    def timeline(d):
+        t, ret = 0.0, []
+        for n in [d] * (lines // d) + [lines % d] * bool(lines % d):
+            ret.append([n, t, t + overhead +
+                min(n * (num + 1), max_rows) * ROW_TIME + n * tline])
+            t = ret[-1][2]
+        return ret
+    div = min(range(1, dmax + 1), key = lambda d: (round(timeline(d)[-1][2],
+        6), any(d * num % c for c in chunks if c > 1), -d))
+    frags = timeline(div)
+    t = frags[-1][2]
+    return 0 if div == lines else div, \
+        {"fragments": frags, "total": t, "dead": t - lines * live}
+
 def encoder_check(panda, tols, motors):
     for motor in motors:
         inp, tol = panda.motors.get(motor), tols.get(motor)
@@ -125,19 +188,89 @@ def vbas_check(ratios, args, kwargs):
     ratio = ratios.get(motor)
     if ratio is None:
         return
-    velocity = velo_simple(motor, lo, hi, num, kwargs["duty"],
-        *(kwargs.get(k) for k in ["period", "velocity", "pad"]))[1]
+    velocity = velo_get(args, kwargs)[1][1]
     if velocity < ratio * caget(motor.prefix + ".VBAS"):
         raise RuntimeError("%s.velocity < %f * %s.motor_vbas" %
             (motor.vname(), ratio, motor.vname()))
 
+# Frame counters are followed by monitors, and only read by CA (on a worker
+# thread) when the monitored values are too low (too high ones are errors
+# right away, as the counters only rise); with `direct', the
+# lengths of the datasets in the SWMR files are also checked on the worker.
+# Both are allowed `grace' seconds to catch up.  Errors are raised at the
+# next event or at the end of the run.
 class HDF5Checker(CallbackBase):
-    def __init__(self, tols, dets, num):
+    def __init__(self, tols, dets, num, direct = False, grace = 1.0):
         self.tols, self.dets, self.num = tols, dets, num
+        self.direct, self.grace = direct, grace
 
     def start(self, doc):
         self.idx = [0, 0]
         self.names = {}, {}
+        self.errors, self.counts, self.files = [], {}, {}
+        self.q, self.deadline = queue.Queue(), math.inf
+        self.subs = [(det.hdf1.array_counter, det.hdf1.array_counter.subscribe
+            ((lambda det: lambda *, value, **kwargs:
+            self.counts.__setitem__(det, value))(det)))
+            for det in self.dets if self.tols.get(det) is not None]
+        self.thread = threading.Thread(target = self.worker, daemon = True)
+        self.thread.start()
+
+    def length(self, det):
+        if det not in self.files:
+            self.files[det] = h5py.File(det.hdf1.full_file_name.get(),
+                "r", swmr = True)["entry/data/data"]
+        d = self.files[det]
+        d.refresh()
+        return d.shape[0]
+
+    # Waits up to `grace' seconds (or until the deadline set when stopping)
+    # for `get()' to reach `cur - tol'; as the counters keep rising after the
+    # event, only this lower bound holds here.
+    def wait(self, get, cur, tol):
+        deadline = min(time.monotonic() + self.grace, self.deadline)
+        while True:
+            cnt = get()
+            if cnt >= cur - tol or time.monotonic() >= deadline:
+                return cnt
+            time.sleep(0.05)
+
+    def check(self, cur, det, tol, cnt):
+        if cnt is None or cnt < cur - tol:
+            cnt = self.wait(lambda: det.hdf1.array_counter.get
+                (use_monitor = False), cur, tol)
+            if cnt < cur - tol:
+                self.fail(det.hdf1.array_counter.vname(), cnt, cur)
+        if self.direct:
+            cnt = self.wait(lambda: self.length(det), cur, tol)
+            if cnt < cur - tol:
+                self.fail(det.hdf1.full_file_name.get(), cnt, cur)
+
+    # Only the latest queued check for each detector is done, which implies
+    # the earlier ones as only lower bounds are checked.
+    def worker(self):
+        done = False
+        while not done:
+            latest = {}
+            for msg in [self.q.get()] + [self.q.get_nowait()
+                for i in range(self.q.qsize())]:
+                if msg is None:
+                    done = True
+                else:
+                    latest[msg[1]] = msg
+            for msg in latest.values():
+                try:
+                    self.check(*msg)
+                except Exception as e:
+                    self.errors.append(e)
+
+    def fail(self, name, cnt, cur):
+        self.errors.append(RuntimeError(("Unexpected value of %s:" +
+            " %d, should be %d") % (name, cnt, cur)))
+
+    def raise_errors(self):
+        if self.errors:
+            raise self.errors[0]
 
     def descriptor(self, doc):
         if doc["name"] in self.names[1]:
@@ -146,9 +279,13 @@ class HDF5Checker(CallbackBase):
         self.names[1][doc["name"]] = doc["uid"]
 
     def event(self, doc):
-        if self.names[0][doc["descriptor"]] == "primary":
+        self.raise_errors()
+        name = self.names[0][doc["descriptor"]]
+        if name == "primary":
             self.idx[1] += 1
             return
+        elif name != "flying":
+            return
         self.idx[0] += 1
         if self.idx[0] % 2:
             return
@@ -157,41 +294,76 @@ class HDF5Checker(CallbackBase):
             tol = self.tols.get(det)
             if tol is None:
                 continue
-            sig = det.hdf1.array_counter
-            cnt = sig.get()
-            if not (cur - tol <= cnt <= cur):
-                raise RuntimeError(("Unexpected value of %s:" +
-                    " %d, should be %d") % (sig.vname(), cnt, cur))
+            cnt = self.counts.get(det)
+            if cnt is not None and cnt > cur:
+                self.fail(det.hdf1.array_counter.vname(), cnt, cur)
+            elif self.direct or cnt is None or cnt < cur - tol:
+                self.q.put((cur, det, tol, cnt))
+
+    # Pending checks share one `grace' period after the stop document.
+    def stop(self, doc):
+        self.deadline = time.monotonic() + self.grace
+        self.q.put(None)
+        self.thread.join(2 * self.grace + 1.0)
+        if self.thread.is_alive():
+            self.errors.append(RuntimeError("HDF5 checks timed out"))
+        for sig, sub in self.subs:
+            sig.unsubscribe(sub)
+        for d in self.files.values():
+            d.file.close()
+        self.raise_errors()
 
 class BuboPlanner(ChildPlanner):
-    def __init__(self, bubo, *, divs = {}, h5_tols = {}):
+    def __init__(self, bubo, *, divs = {}, h5_tols = {}, h5_direct = False):
         super().__init__()
-        self.h5_tols = h5_tols
+        self.h5_tols, self.h5_direct = h5_tols, h5_direct
         self.plans["sfly_grid"] = lambda dets, *args, **kwargs: sfly_simple\
             (bubo, dets, *args, div = div_get(divs, dets, args[-1]), **kwargs)
 
     def callback(self, plan, *args, **kwargs):
-        return [HDF5Checker(self.h5_tols, args[0], args[-1]),
-            self.U.mzcb, self.parent.progress]
+        return [HDF5Checker(self.h5_tols, args[0], args[-1],
+            self.h5_direct), self.U.mzcb, self.parent.progress]
 
 class PandaPlanner(ChildPlanner):
     def __init__(self, panda, adp, *, divs = {}, h5_tols = {},
-        enc_tols = {}, vbas_ratios = {}, configs = {}):
+        h5_direct = False, enc_tols = {}, vbas_ratios = {},
+        configs = {}, pcap = None):
         super().__init__()
-        self.panda, self.h5_tols, self.enc_tols, self.vbas_ratios = \
-            panda, h5_tols, enc_tols, vbas_ratios
+        self.panda, self.h5_tols, self.h5_direct, self.enc_tols, \
+            self.vbas_ratios = panda, h5_tols, h5_direct, enc_tols, vbas_ratios
+        # The predicted timeline goes into the start document.
+        def fly(f, dets, *args, md = None, **kwargs):
+            div, timeline = div_auto(divs, dets, args, kwargs,
+                panda.dseq.max_rows())
+            return f(panda, adp, dets, *args, configs = configs, pcap = pcap,
+                div = div, md = dict(md or {}, fly_timeline = timeline),
+                **kwargs)
         for k, f in [("fly_grid", fly_simple),
-            ("fly_dgrid", fly_dsimple), ("fly_pgrid", fly_pcomp)]:
-            self.plans[k] = (lambda f: lambda dets, *args, **kwargs: f(
-                panda, adp, dets, *args, configs = configs,
-                div = div_get(divs, dets, args[-1]), **kwargs
-            ))(f)
+            ("fly_dgrid", fly_dsimple), ("fly_pgrid", fly_pcomp),
+            ("fly_ggrid", fly_gtime),
+            ("fly_hgrid", fly_hpcomp), ("fly_cgrid", fly_cgrid)]:
+            self.plans[k] = (lambda f: lambda *args, **kwargs:
+                fly(f, *args, **kwargs))(f)
+        self.plans["fly_list"] = lambda dets, *args, **kwargs: \
+            fly_list_pcomp(panda, adp, dets, *args,
+                configs = configs, pcap = pcap, **kwargs)
+        self.plans["fly_count"] = lambda dets, num, **kwargs: \
+            fly_tcount(panda, adp, dets, num,
+                configs = configs, pcap = pcap, **kwargs)
 
     def check(self, plan, *args, **kwargs):
+        if plan == "fly_count":
+            return
+        if plan == "fly_list":
+            encoder_check(self.panda, self.enc_tols,
+                motors_get(args[1:], use_list = True))
+            return
         encoder_check(self.panda, self.enc_tols, motors_get(args[1:]))
         vbas_check(self.vbas_ratios, args[1:], kwargs)
 
     def callback(self, plan, *args, **kwargs):
-        return [HDF5Checker(self.h5_tols, args[0], args[-1]),
-            self.U.mzcb, self.parent.progress]
+        if plan == "fly_list":
+            return [self.U.mzcb, self.parent.progress]
+        return [HDF5Checker(self.h5_tols, args[0], args[-1],
+            self.h5_direct), self.U.mzcb, self.parent.progress]
 
@@ -1,6 +1,8 @@
 import collections
 from bluesky.callbacks.core import CallbackBase
 
+progressStreams = ["primary", "flying"]
+
 class ProgressReporter(object):
     def __init__(self, bars, notify):
         self.bars, self.notify = bars, notify
@@ -31,9 +33,12 @@ class ProgressBase(CallbackBase):
         return self.table[idx]
 
     def start(self, doc):
-        self.idx, self.prev = 0, None
+        self.idx, self.prev, self.names = 0, None, {}
         self.progress = {k: [0, 0.0] for k in self.steps}
 
+    def descriptor(self, doc):
+        self.names[doc["uid"]] = doc["name"]
+
     def eta(self, diff):
         prog = self.progress[self.key(self.idx)]
         prog[0], prog[1] = prog[0] + 1, prog[1] + diff
@@ -48,6 +53,9 @@ class ProgressBase(CallbackBase):
         return remain + used / self.idx * nul
 
     def event(self, doc):
+        # Eg. pages collected from flyers are not steps of the scan.
+        if self.names.get(doc["descriptor"]) not in progressStreams:
+            return
         prev, self.prev = self.prev, doc["time"]
         diff = None if prev is None else self.prev - prev
         eta = None if diff is None else self.eta(diff)